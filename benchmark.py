@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+"""
+Benchmark for check_proxmox_backup.py.
+
+Generates synthetic dump directories and a local fake Proxmox API
+(mock_proxmox.py) for clusters of different sizes, runs the complete check
+against each of them and prints one JSON object per scenario with:
+
+wall_s         - wall time of the whole check run
+files_opened   - files opened below the dump directory
+dirs_scanned   - directory listings of the dump directory
+max_rss_kb     - peak memory of the check
+api_calls      - requests per API path
+exit_code      - exit code of the check (0 OK, 1 WARNING, 2 CRITICAL)
+
+Example:
+
+python benchmark.py -n 10,100,1000,10000 -r 14 -s 65536 -o results.jsonl
+
+The mix of backups is given as percentages of ok:failed:running:missing VMs.
+Failed and running VMs have an older successful backup, missing VMs have
+no log in the last three days, which makes the check probe older days.
+
+With --startup the startup time of the check is measured first: the median
+time to import it and of a whole run that stops before the first API
+request, and whether requests got imported on the way. The benchmark exits
+with 1 if the run takes longer than --budget milliseconds.
+"""
+
+import json
+import os
+import statistics
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from optparse import OptionParser
+
+from mock_proxmox import MockProxmox, makecert
+
+check = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'check_proxmox_backup.py')
+
+# Runs the check inside the child process and counts its file system access
+wrapper = '''
+import atexit, json, os, resource, runpy, sys
+stats, dumproot = sys.argv[1], sys.argv[2]
+counts = {'files_opened': 0, 'dirs_scanned': 0}
+def hook(event, args):
+    if event == 'open' and isinstance(args[0], str) and args[0].startswith(dumproot):
+        counts['files_opened'] += 1
+    elif event in ('os.scandir', 'os.listdir') and str(args[0]).startswith(dumproot):
+        counts['dirs_scanned'] += 1
+    elif event == 'subprocess.Popen' and any(str(arg).startswith(dumproot) for arg in args[1]):
+        # dump directories are listed by a child process (--storagetimeout)
+        counts['dirs_scanned'] += 1
+def report():
+    counts['max_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    with open(stats, 'w') as f:
+        json.dump(counts, f)
+sys.addaudithook(hook)
+atexit.register(report)
+sys.argv = sys.argv[3:]
+runpy.run_path(sys.argv[0], run_name='__main__')
+'''
+
+# Imports the check like a scheduler keeping it loaded would
+importer = '''
+import json, sys, time
+start = time.perf_counter()
+sys.path.insert(0, sys.argv[1])
+import check_proxmox_backup
+print(json.dumps({'import_ms': (time.perf_counter() - start) * 1000,
+                  'heavy_imports': sorted(name for name in ('requests', 'urllib3') if name in sys.modules)}))
+'''
+
+
+def startup(repeat, budget):
+    """Measure how long the check takes to start, medians of repeat runs."""
+    imports = []
+    runs = []
+    heavy = set()
+    for run in range(repeat):
+        process = subprocess.run([sys.executable, '-c', importer, os.path.dirname(check)],
+                                 stdout=subprocess.PIPE, universal_newlines=True, check=True)
+        result = json.loads(process.stdout)
+        imports.append(result['import_ms'])
+        heavy.update(result['heavy_imports'])
+        # without credentials the check stops before it logs in
+        start = time.time()
+        subprocess.run([sys.executable, check], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        runs.append((time.time() - start) * 1000)
+    run_ms = statistics.median(runs)
+    return {'scenario': 'startup', 'runs': repeat, 'import_ms': round(statistics.median(imports), 1),
+            'run_ms': round(run_ms, 1), 'heavy_imports': sorted(heavy), 'budget_ms': budget,
+            'within_budget': run_ms <= budget}
+
+
+def parsemix(mix):
+    shares = [float(share) for share in mix.split(':')]
+    if len(shares) != 4 or sum(shares) <= 0:
+        raise ValueError('mix must look like ok:failed:running:missing')
+    return [share / sum(shares) for share in shares]
+
+
+def writelog(path, vmid, when, lastline, size):
+    filename = '%s/vzdump-qemu-%d-%s.log' % (path, vmid, when.strftime('%Y_%m_%d-%H_%M_%S'))
+    with open(filename, 'w') as f:
+        f.write('INFO: starting new backup job: vzdump %d\n' % vmid)
+        padding = 'INFO: status: 1%% (1.0 GiB of 100.0 GiB), duration 1, read: 1.0 MiB/s, write: 1.0 MiB/s\n'
+        written = 0
+        while written < size:
+            f.write(padding)
+            written += len(padding)
+        f.write(lastline + '\n')
+
+
+def makedumpdir(path, vms, retention, size, mix):
+    """Write retention days of logs for every VM, today's log depends on the mix."""
+    os.makedirs(path)
+    today = datetime.now().replace(hour=0, minute=0, second=1, microsecond=0)
+    ok, failed, running, missing = mix
+    for vmid in range(100, 100 + vms):
+        position = float(vmid - 100) / vms
+        if position < ok:
+            kind = 'ok'
+        elif position < ok + failed:
+            kind = 'failed'
+        elif position < ok + failed + running:
+            kind = 'running'
+        else:
+            kind = 'missing'
+        for day in range(retention):
+            when = today - timedelta(days=day)
+            if kind == 'missing' and day < 3:
+                continue
+            if day == 0 and kind == 'failed':
+                lastline = 'ERROR: Backup of VM %d failed - storage unavailable' % vmid
+            elif day == 0 and kind == 'running':
+                lastline = 'INFO: status: 42% (42.0 GiB of 100.0 GiB), duration 300'
+            else:
+                lastline = 'INFO: Finished Backup of VM %d (00:05:00)' % vmid
+            writelog(path, vmid, when, lastline, size)
+
+
+def fixtures(vms, storagepath):
+    storage = {'storage': 'bench', 'type': 'dir', 'path': storagepath, 'content': 'backup'}
+    guests = [{'id': 'qemu/%d' % vmid, 'type': 'qemu', 'vmid': vmid, 'node': 'bench'}
+              for vmid in range(100, 100 + vms)]
+    return {
+        'cluster/backup': {'data': [{'id': 'backup-bench', 'enabled': 1, 'all': 1, 'storage': 'bench',
+                                     'schedule': '00:00', 'mode': 'snapshot'}]},
+        'cluster/resources': {'data': guests + [{'id': 'node/bench', 'type': 'node', 'node': 'bench'}]},
+        'storage': {'data': [storage]},
+    }
+
+
+def runcheck(server, dumproot, workers, workdir):
+    stats = os.path.join(workdir, 'stats.json')
+    command = [sys.executable, '-c', wrapper, stats, dumproot, check,
+               '-s', server.host, '--port', str(server.port), '-u', 'bench@pam', '-p', 'bench',
+               '--nocache', '-w', str(workers)]
+    start = time.time()
+    process = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    wall = time.time() - start
+    with open(stats) as f:
+        result = json.load(f)
+    result['wall_s'] = round(wall, 4)
+    result['exit_code'] = process.returncode
+    result['output_bytes'] = len(process.stdout)
+    if process.returncode > 2:
+        result['error'] = (process.stdout + process.stderr).strip().splitlines()[-1:]
+    return result
+
+
+def main():
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('-n', '--vms', dest='vms', default='10,100,1000',
+                      help='Comma separated VM counts, one scenario each (default 10,100,1000)')
+    parser.add_option('-r', '--retention', dest='retention', default=7, type='int',
+                      help='Days of logs per VM (default 7)')
+    parser.add_option('-s', '--size', dest='size', default=4096, type='int',
+                      help='Approximate size of every log in bytes (default 4096)')
+    parser.add_option('-m', '--mix', dest='mix', default='90:4:3:3',
+                      help='Percentages of ok:failed:running:missing VMs (default 90:4:3:3)')
+    parser.add_option('-w', '--workers', dest='workers', default='1',
+                      help='Comma separated --workers values of the check (default 1)')
+    parser.add_option('-l', '--latency', dest='latency', default=0.0, type='float',
+                      help='Seconds the fake API delays every answer (default 0)')
+    parser.add_option('-k', '--repeat', dest='repeat', default=1, type='int',
+                      help='Runs per scenario (default 1)')
+    parser.add_option('-o', '--output', dest='output', default='',
+                      help='Also append the results to this file')
+    parser.add_option('--startup', dest='startup', default=0, type='int',
+                      help='Measure the startup time of the check this many times first')
+    parser.add_option('--budget', dest='budget', default=200.0, type='float',
+                      help='Startup time budget in milliseconds (default 200)')
+    (options, args) = parser.parse_args()
+
+    overbudget = False
+    if options.startup > 0:
+        result = startup(options.startup, options.budget)
+        overbudget = not result['within_budget']
+        line = json.dumps(result, sort_keys=True)
+        if options.output:
+            with open(options.output, 'a') as f:
+                f.write(line + '\n')
+        print(line)
+
+    mix = parsemix(options.mix)
+    workdir = tempfile.mkdtemp(prefix='check_proxmox_bench.')
+    try:
+        certfile, keyfile = makecert(workdir)
+        for vms in [int(vms) for vms in options.vms.split(',')]:
+            dumproot = os.path.join(workdir, 'storage-%d' % vms)
+            makedumpdir(os.path.join(dumproot, 'dump'), vms, options.retention, options.size, mix)
+            for workers in [int(workers) for workers in options.workers.split(',')]:
+                for run in range(options.repeat):
+                    server = MockProxmox(fixtures(vms, dumproot), certfile, keyfile,
+                                         latency=options.latency)
+                    server.start()
+                    try:
+                        result = runcheck(server, dumproot, workers, workdir)
+                    finally:
+                        server.stop()
+                    scenario = {'vms': vms, 'retention': options.retention, 'log_size': options.size,
+                                'mix': options.mix, 'workers': workers, 'run': run,
+                                'time': datetime.now().isoformat(timespec='seconds')}
+                    scenario.update(result)
+                    scenario['api_calls'] = server.calls
+                    line = json.dumps(scenario, sort_keys=True)
+                    if options.output:
+                        with open(options.output, 'a') as f:
+                            f.write(line + '\n')
+                    print(line)
+            shutil.rmtree(dumproot)
+    finally:
+        shutil.rmtree(workdir)
+    if overbudget:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
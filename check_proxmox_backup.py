@@ -12,17 +12,18 @@ E-Mail: roland.gsell@siedl.net
 
 """
 
-from pyproxmox import prox_auth, pyproxmox
-import urllib3
 from datetime import datetime, date, timedelta
-import fnmatch
+import bisect
+import fcntl
+import json
 import os
+import re
 from optparse import OptionParser
 import configparser
-import string
 import sys
-
-urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+import tempfile
+import threading
+import time
 
 
 class Nagios:
@@ -35,10 +36,25 @@ class Nagios:
 nagios = Nagios()
 
 
-def nagiosExit(exit_code, msg=None):
+def nagiosOutput(exit_code, msg, perfdata=None):
+    """Return the plugin output, the perfdata goes to the end of the first line."""
+    msg = str(msg)
+    if perfdata:
+        lines = msg.split('\n', 1)
+        lines[0] += " | " + perfdata
+        msg = '\n'.join(lines)
+    return str(exit_code[0]) + ' ' + exit_code[1] + " - " + msg
+
+
+def nagiosExit(exit_code, msg=None, perfdata=None):
     """Exit script with a str() message and an integer 'nagios_code', which is a sys.exit level."""
     if msg:
-        print(exit_code[0], exit_code[1] + " - " + str(msg))
+        if options.format == 'json':
+            print(jsonresult(exit_code, str(msg), {}, perfdata or ''))
+        else:
+            print(nagiosOutput(exit_code, msg, perfdata))
+    # the runs which end early are the interesting ones to trace
+    savetrace()
     sys.exit(exit_code[0])
 
 
@@ -53,11 +69,21 @@ parser.add_option("-p",
                   dest="password",
                   default='',
                   help="Password for the API-User")
+parser.add_option("-t",
+                  "--token",
+                  dest="token",
+                  default='',
+                  help="API token (user@realm!tokenid=secret) instead of user and password")
 parser.add_option("-s",
                   "--host",
                   dest="host",
                   default='',
                   help="PVE-Server")
+parser.add_option("--port",
+                  dest="port",
+                  default=8006,
+                  type="int",
+                  help="Port of the PVE-API (default 8006)")
 parser.add_option("-P",
                   "--path",
                   dest="path",
@@ -74,7 +100,142 @@ parser.add_option("-d",
                   default=False,
                   action="store_true",
                   help="Turn on debug mode")
-(options, args) = parser.parse_args()
+parser.add_option("-w",
+                  "--workers",
+                  dest="workers",
+                  default=1,
+                  type="int",
+                  help="Number of VMs to check in parallel (default 1)")
+parser.add_option("--storagetimeout",
+                  dest="storagetimeout",
+                  default=10.0,
+                  type="float",
+                  help="Seconds a dump directory may take to be listed before its storage counts as "
+                       "unreachable (default 10, 0 to list it in the check itself)")
+parser.add_option("--record",
+                  dest="record",
+                  default='',
+                  help="Save all API answers to this file as fixtures for mock_proxmox.py")
+parser.add_option("--timings",
+                  dest="timings",
+                  default=False,
+                  action="store_true",
+                  help="Add the time spent for login, API, directory scans and log reads as perfdata")
+parser.add_option("--trace",
+                  dest="trace",
+                  default='',
+                  help="Write a Chrome trace / Perfetto JSON file of this run")
+parser.add_option("--vmperfdata",
+                  dest="vmperfdata",
+                  default=False,
+                  action="store_true",
+                  help="Add duration, size and throughput of the last backup of every VM as perfdata")
+parser.add_option("--format",
+                  dest="format",
+                  default='text',
+                  type="choice",
+                  choices=['text', 'json', 'dict'],
+                  help="Output format: text (counts, then the VMs which are not ok), json or dict "
+                       "(all VMs, like older versions)")
+parser.add_option("--maxbytes",
+                  dest="maxbytes",
+                  default=4096,
+                  type="int",
+                  help="Cut the text output to this many bytes, 0 for no limit (default 4096)")
+parser.add_option("-b",
+                  "--batch",
+                  dest="batch",
+                  default=False,
+                  action="store_true",
+                  help="Check all clusters of the API Configuration File at the same time")
+parser.add_option("--statusdir",
+                  dest="statusdir",
+                  default='',
+                  help="Batch mode: write the result of every cluster to DIR/<section>.status")
+parser.add_option("--passive",
+                  dest="passive",
+                  default='',
+                  help="Batch mode: append the results as passive check results to this file or command pipe")
+parser.add_option("--verify",
+                  dest="verify",
+                  default='',
+                  type="choice",
+                  choices=['', 'header', 'full'],
+                  help="Verify the archive of the last finished backup: header (size and header) "
+                       "or full (decompress it)")
+parser.add_option("--verifyworkers",
+                  dest="verifyworkers",
+                  default=2,
+                  type="int",
+                  help="Number of archives to verify at the same time (default 2)")
+parser.add_option("--verifyrate",
+                  dest="verifyrate",
+                  default=0.0,
+                  type="float",
+                  help="Read archives with at most this many MB/s altogether, 0 for no limit (default)")
+parser.add_option("--filerate",
+                  dest="filerate",
+                  default=0.0,
+                  type="float",
+                  help="Open at most this many log files and archives per second, 0 for no limit (default)")
+parser.add_option("--readrate",
+                  dest="readrate",
+                  default=0.0,
+                  type="float",
+                  help="Read at most this many MB/s from logs and archives, 0 for no limit (default)")
+parser.add_option("--idle",
+                  dest="idle",
+                  default=False,
+                  action="store_true",
+                  help="Run in the idle I/O scheduling class and with the lowest CPU priority")
+parser.add_option("--sample",
+                  dest="sample",
+                  default=0,
+                  type="int",
+                  help="Read logs of running backups at most every this many seconds while their job's "
+                       "backup window is open (default 0: always)")
+parser.add_option("--backupwindow",
+                  dest="backupwindow",
+                  default=240,
+                  type="int",
+                  help="Minutes after the start of a backup job in which --sample applies (default 240)")
+parser.add_option("--resultttl",
+                  dest="resultttl",
+                  default=0,
+                  type="int",
+                  help="Reuse the result of a run with the same arguments for this many seconds "
+                       "(default 0: never)")
+parser.add_option("--resultcache",
+                  dest="resultcache",
+                  default='',
+                  help="Directory for the cached results (default: next to the API Configuration File)")
+parser.add_option("--textfile",
+                  dest="textfile",
+                  default='',
+                  help="Also write the status of every VM as Prometheus metrics to this file for node_exporter")
+parser.add_option("--deadline",
+                  dest="deadline",
+                  default=0.0,
+                  type="float",
+                  help="Stop after this many seconds and report the VMs checked so far as UNKNOWN "
+                       "(default 0: no deadline)")
+parser.add_option("--retries",
+                  dest="retries",
+                  default=2,
+                  type="int",
+                  help="Repeat failed API GET requests this many times (default 2)")
+parser.add_option("-c",
+                  "--cache",
+                  dest="cachefile",
+                  default='',
+                  help="Path to the log status cache (default: next to the API Configuration File)")
+parser.add_option("--nocache",
+                  dest="nocache",
+                  default=False,
+                  action="store_true",
+                  help="Do not use the log status and ticket cache")
+# replaced by main(), the defaults let the functions be used after an import
+options = parser.get_default_values()
 
 
 def printdebug(string):
@@ -82,369 +243,1697 @@ def printdebug(string):
         print(string)
 
 
-def getweekday(weekdaynumber):
-    weekday = ''
-    if weekdaynumber == 0:
-        weekday = 'mon'
-    elif weekdaynumber == 1:
-        weekday = 'tue'
-    elif weekdaynumber == 2:
-        weekday = 'wed'
-    elif weekdaynumber == 3:
-        weekday = 'thu'
-    elif weekdaynumber == 4:
-        weekday = 'fri'
-    elif weekdaynumber == 5:
-        weekday = 'sat'
-    elif weekdaynumber == 6:
-        weekday = 'sun'
-    return weekday
+weekdays = ['mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun']
+calendar_aliases = {'minutely': '*:*', 'hourly': '*:00', 'daily': '00:00', 'weekly': 'mon 00:00'}
+minutes_per_week = 7 * 24 * 60
+
+# schedule -> sorted run times in minutes since monday 00:00
+compiled_schedules = {}
+
+
+def parsecalendarvalues(spec, maximum, names=None):
+    """Parse a comma separated list of values, ranges (a..b) and repetitions (a/r, a..b/r, */r)."""
+    values = set()
+    for part in spec.split(','):
+        step = 1
+        repeat = '/' in part
+        if repeat:
+            part, step = part.split('/', 1)
+            step = int(step)
+            if step < 1:
+                raise ValueError('Invalid repetition: ' + spec)
+        if part == '*':
+            start, end = 0, maximum
+        elif '..' in part:
+            start, end = [parsecalendarvalue(value, names) for value in part.split('..', 1)]
+        else:
+            start = parsecalendarvalue(part, names)
+            end = maximum if repeat else start
+        if start > end or end > maximum:
+            raise ValueError('Invalid range: ' + spec)
+        values.update(range(start, end + 1, step))
+    return values
+
+
+def parsecalendarvalue(value, names):
+    if names and value in names:
+        return names.index(value)
+    return int(value)
+
+
+def compileschedule(spec):
+    """
+    Compile a schedule into a table of all run times of a week.
+
+    Understands the weekday and time parts of PVE calendar events
+    (e.g. 'mon..fri 02:30', '*/2:00', 'sat,sun 8..17:0/15') and their
+    aliases. Legacy jobs are passed as 'dow starttime' ('mon,wed 21:00').
+    Raises ValueError for anything else, e.g. calendar events with dates.
+    """
+    if spec in compiled_schedules:
+        return compiled_schedules[spec]
+    words = calendar_aliases.get(spec.strip(), spec).split()
+    days = set(range(7))
+    hours = set([0])
+    minutes = set([0])
+    if words and words[0][0].isalpha():
+        days = parsecalendarvalues(words.pop(0), 6, weekdays)
+    if words:
+        timespec = words.pop(0)
+        if '-' in timespec or words:
+            raise ValueError('Unsupported calendar event: ' + spec)
+        fields = timespec.split(':')
+        if len(fields) == 1:
+            # only minutes are given, every hour
+            fields = ['*'] + fields
+        hours = parsecalendarvalues(fields[0], 23)
+        minutes = parsecalendarvalues(fields[1], 59)
+    table = sorted(day * 1440 + hour * 60 + minute for day in days for hour in hours for minute in minutes)
+    if not table:
+        raise ValueError('Schedule never runs: ' + spec)
+    compiled_schedules[spec] = table
+    return table
+
+
+def lastruns(table, now, count=2):
+    """Return the count most recent run times of a compiled schedule up to now, newest first."""
+    now = now.replace(second=0, microsecond=0)
+    nowminute = now.weekday() * 1440 + now.hour * 60 + now.minute
+    position = bisect.bisect_right(table, nowminute)
+    runs = []
+    for back in range(1, count + 1):
+        # wrap around into the weeks before
+        weeks, index = divmod(position - back, len(table))
+        minutes = nowminute - table[index] - weeks * minutes_per_week
+        runs.append(now - timedelta(minutes=minutes))
+    return runs
 
 
 errorcodes = ['nobak', 'failed', 'running', '2old']
 okcodes = ['ok']
 
 
-def readlogfile(path, vmid, date, oneday2old=False):
+starttime = time.time()
+
+# counters for --timings, the log files are read from several threads
+timings = {'scan_ms': 0.0, 'dirs_scanned': 0, 'read_ms': 0.0, 'logs_read': 0, 'logs_cached': 0, 'bytes_read': 0,
+           'verify_bytes': 0}
+timings_lock = threading.Lock()
+
+
+def addtimings(**values):
+    with timings_lock:
+        for (name, value) in values.items():
+            timings[name] += value
+
+
+class RateLimit:
+    """Limits how many files or bytes per second all threads together read, 0 means no limit."""
+    def __init__(self, rate):
+        self.rate = rate
+        self.lock = threading.Lock()
+        self.next = time.time()
+
+    def wait(self, size, deadline=None):
+        """Sleep until size may be read, False without sleeping if that is after the deadline."""
+        if self.rate <= 0:
+            return True
+        with self.lock:
+            now = time.time()
+            start = max(self.next, now)
+            if deadline is not None and start >= deadline:
+                return False
+            self.next = start + float(size) / self.rate
+        if start > now:
+            time.sleep(start - now)
+        return True
+
+
+# I/O budget of the whole check, set by --filerate and --readrate
+file_limit = RateLimit(0)
+read_limit = RateLimit(0)
+
+
+def idleio():
+    """Only use disk and CPU time nobody else wants, e.g. running backups."""
+    import subprocess
+    os.nice(19)
+    try:
+        subprocess.check_call(['ionice', '-c', '3', '-p', str(os.getpid())],
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    except (OSError, subprocess.CalledProcessError):
+        printdebug("Cant switch to the idle I/O scheduling class")
+
+
+def perfdata(auth, prox, start, api_ms, counters=None):
+    """
+    Return the cost of checking one cluster as Nagios perfdata, with the
+    directory scan and log read counters if given.
+    """
+    values = [('total_ms', (time.time() - start) * 1000, 'ms'),
+              ('auth_ms', auth.login_time * 1000, 'ms'),
+              ('api_ms', api_ms, 'ms'),
+              ('api_requests', prox.api_requests, '')]
+    if counters is not None:
+        values += countervalues(counters)
+    return formatperfdata(values)
+
+
+def countervalues(counters):
+    return [('scan_ms', counters['scan_ms'], 'ms'),
+            ('dirs_scanned', counters['dirs_scanned'], ''),
+            ('read_ms', counters['read_ms'], 'ms'),
+            ('logs_read', counters['logs_read'], ''),
+            ('logs_cached', counters['logs_cached'], ''),
+            ('bytes_read', counters['bytes_read'], 'B'),
+            ('verify_bytes', counters['verify_bytes'], 'B')]
+
+
+def formatperfdata(values):
+    return ' '.join('%s=%s%s' % (name, round(value, 1), unit) for (name, value, unit) in values)
+
+
+class Trace:
+    """Collects spans of a run as Chrome trace events, see chrome://tracing or ui.perfetto.dev"""
+    def __init__(self):
+        self.events = []
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+
+    def span(self, name, start, end, args):
+        event = {'name': name, 'cat': 'check', 'ph': 'X', 'pid': self.pid, 'tid': threading.get_ident(),
+                 'ts': round((start - starttime) * 1000000), 'dur': round((end - start) * 1000000),
+                 'args': args}
+        with self.lock:
+            self.events.append(event)
+
+    def save(self, filename):
+        with open(filename, 'w') as f:
+            json.dump({'traceEvents': self.events, 'displayTimeUnit': 'ms'}, f)
+
+
+# only set with --trace, nothing is recorded otherwise
+tracer = None
+
+
+def savetrace():
+    """Write the spans recorded so far to the --trace file."""
+    if tracer is None:
+        return
+    try:
+        tracer.save(options.trace)
+    except OSError:
+        printdebug("Cant write trace: " + options.trace)
+
+
+def tracespan(name, start, **args):
+    """Record a span from start until now."""
+    if tracer is not None:
+        tracer.span(name, start, time.time(), args)
+
+
+def lastbackup(vmid, jobs):
+    """
+    Return (log file name, metrics, path) of the newest finished backup of
+    a VM in the paths of its jobs, or None.
+    """
+    for path in set(job[0] for job in jobs):
+        if path not in unreachable_paths:
+            newestfinished(path, vmid)
+    found = [vmid_metrics[(path, vmid)] + (path,) for path in set(job[0] for job in jobs)
+             if (path, vmid) in vmid_metrics]
+    if not found:
+        return None
+    return max(found, key=lambda backup: backup[0])
+
+
+def vmperfdata(vmid_jobs):
+    """Return the metrics of the last finished backup of every VM as Nagios perfdata."""
+    values = []
+    for vmid in sorted(vmid_jobs):
+        backup = lastbackup(vmid, vmid_jobs[vmid])
+        if backup is None:
+            continue
+        metrics = backup[1]
+        for (name, unit) in [('duration', 's'), ('transferred', 'B'), ('throughput', ''),
+                             ('archive_size', 'B')]:
+            if name in metrics:
+                values.append('vm%d_%s=%d%s' % (vmid, name, metrics[name], unit))
+    return ' '.join(values)
+
+
+# vzdump-qemu-100-2017_01_31-02_00_01.log
+logname_re = re.compile(r'^vzdump-[a-z]+-(\d+)-(\d{4}_\d{2}_\d{2})-(\d{2}_\d{2}_\d{2})\.log$')
+# vzdump-qemu-100-2017_01_31-02_00_01.vma.zst, vzdump-lxc-101-2017_01_31-02_00_01.tar.lzo, ...
+archivename_re = re.compile(r'^(vzdump-[a-z]+-\d+-\d{4}_\d{2}_\d{2}-\d{2}_\d{2}_\d{2})'
+                            r'\.(vma|tar|tgz)(?:\.(zst|lzo|gz))?$')
+
+# path -> {vmid: [(timestamp, filename), ...]} sorted by timestamp
+dumpdir_index = {}
+# path -> {log file name without .log: archive file name}
+dumpdir_archives = {}
+# dump directories of backup jobs which started less than --backupwindow minutes ago
+busy_paths = set()
+# seconds to keep the status of running backups on busy paths, 0 to always read them
+running_sample = 0
+# (path, vmid, date) -> (code, found)
+logfile_results = {}
+# (path, vmid) -> (log file name, metrics) of the newest finished backup
+vmid_metrics = {}
+# dump directories which could not be listed within --storagetimeout
+unreachable_paths = set()
+# path -> lock, so threads needing the same dump directory scan it only once
+scan_locks = {}
+scan_locks_lock = threading.Lock()
+
+# Lists a dump directory for listdumpdir(), a dead NFS server only blocks this child
+probe_script = '''
+import os, sys
+names = os.listdir(sys.argv[1])
+sys.stdout.buffer.write(b'\\0'.join(os.fsencode(name) for name in names))
+'''
+
+
+def resetscans():
+    """Forget the directory scans and log results, evaluate() starts with this."""
+    dumpdir_index.clear()
+    dumpdir_archives.clear()
+    logfile_results.clear()
+    vmid_metrics.clear()
+    unreachable_paths.clear()
+    with scan_locks_lock:
+        scan_locks.clear()
+
+
+def resetstate():
+    """Forget the directory scans, results and counters of a previous run in this process."""
+    resetscans()
+    busy_paths.clear()
+    with timings_lock:
+        for name in timings:
+            timings[name] = type(timings[name])()
+
+
+def probelock(path, timeout):
+    """
+    Lock the probe of a dump directory, shared by all runs on this host.
+    Returns the locked file, None if locking is not possible here, or False
+    if the probe of another run did not finish within the timeout.
+    """
+    import hashlib
+    name = 'check_proxmox_backup.probe.%s.lock' % hashlib.sha256(os.fsencode(path)).hexdigest()[:16]
+    try:
+        lockfile = open(os.path.join(tempfile.gettempdir(), name), 'a')
+    except OSError:
+        return None
+    end = time.time() + timeout
+    while True:
+        try:
+            fcntl.flock(lockfile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return lockfile
+        except BlockingIOError:
+            if time.time() >= end:
+                lockfile.close()
+                return False
+            time.sleep(0.1)
+
+
+def listdumpdir(path, timeout, deadline=None):
+    """
+    Return the file names in a dump directory. With a timeout a child process
+    lists them, so a hanging NFS or CIFS mount can't block the check. If it
+    doesn't answer in time, the child is killed and left behind, the path is
+    added to unreachable_paths and [] returned. The child keeps the probe
+    lock until it is gone, so later runs don't pile up more hanging probes;
+    they wait up to the timeout for it before their own probe gets the
+    full timeout. Both waits end at the deadline (a time.time()) at the latest.
+    """
+    if timeout <= 0:
+        with os.scandir(path) as entries:
+            return [entry.name for entry in entries]
+    import subprocess
+
+    def remaining():
+        if deadline is None:
+            return timeout
+        return max(min(timeout, deadline - time.time()), 0)
+
+    if remaining() <= 0:
+        # its VMs are skipped anyway
+        printdebug('Deadline reached before listing: ' + path)
+        return []
+    lockfile = probelock(path, remaining())
+    if lockfile is False:
+        printdebug('Probe of another run still hangs on: ' + path)
+        unreachable_paths.add(path)
+        return []
+    try:
+        process = subprocess.Popen([sys.executable, '-I', '-S', '-c', probe_script, path],
+                                   stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                   pass_fds=[lockfile.fileno()] if lockfile else [])
+        try:
+            output, _ = process.communicate(timeout=remaining())
+        except subprocess.TimeoutExpired:
+            process.kill()
+            printdebug('No answer from dump directory in time: ' + path)
+            unreachable_paths.add(path)
+            return []
+    finally:
+        if lockfile:
+            lockfile.close()
+    if process.returncode != 0:
+        raise OSError('Cant list ' + path)
+    return [os.fsdecode(name) for name in output.split(b'\0') if name]
+
+
+def scandumpdir(path, storage='', deadline=None):
+    """Scan a dump directory once and index its log files by vmid and timestamp."""
+    if path in dumpdir_index:
+        return dumpdir_index[path]
+    with scan_locks_lock:
+        lock = scan_locks.setdefault(path, threading.Lock())
+    with lock:
+        # another thread may have scanned it while we waited
+        if path in dumpdir_index:
+            return dumpdir_index[path]
+        return indexdumpdir(path, storage, deadline)
+
+
+def indexdumpdir(path, storage='', deadline=None):
+    """Read the dump directory for scandumpdir()."""
+    start = time.time()
+    index = {}
+    archives = {}
+    printdebug('Scanning dump directory: ' + path)
+    try:
+        for name in listdumpdir(path, options.storagetimeout, deadline):
+            match = logname_re.match(name)
+            if match:
+                vmid = int(match.group(1))
+                timestamp = match.group(2) + '-' + match.group(3)
+                index.setdefault(vmid, []).append((timestamp, name))
+                continue
+            match = archivename_re.match(name)
+            if match:
+                archives[match.group(1)] = name
+    except OSError:
+        printdebug("Cant read directory: " + path)
+    for logs in index.values():
+        logs.sort()
+    # never replace a scan we already have
+    dumpdir_archives.setdefault(path, archives)
+    index = dumpdir_index.setdefault(path, index)
+    addtimings(scan_ms=(time.time() - start) * 1000, dirs_scanned=1)
+    tracespan('scan directory', start, storage=storage, path=path, unreachable=path in unreachable_paths)
+    return index
+
+
+def findlogfiles(path, vmid, date):
+    """Return the log file names of a VM for one day (YYYY_MM_DD), oldest first."""
+    logs = scandumpdir(path).get(int(vmid), [])
+    start = bisect.bisect_left(logs, (date + '-',))
+    end = bisect.bisect_left(logs, (date + '.',))
+    return [filename for (timestamp, filename) in logs[start:end]]
+
+
+def latestlogfile(path, vmid, date):
+    """Return (timestamp, filename) of the newest log of a VM on or before the given day, or None."""
+    logs = scandumpdir(path).get(int(vmid), [])
+    pos = bisect.bisect_left(logs, (date + '.',))
+    if pos == 0:
+        return None
+    return logs[pos - 1]
+
+
+tail_chunksize = 4096
+logmarkers = ['INFO: Finished Backup', 'ERROR: ', 'INFO: status:']
+
+
+# how far to look back from the end of a finished log for its metrics
+tail_metricsbytes = 65536
+
+units = {'B': 1, 'KB': 1000, 'MB': 1000 ** 2, 'GB': 1000 ** 3, 'TB': 1000 ** 4,
+         'KIB': 1024, 'MIB': 1024 ** 2, 'GIB': 1024 ** 3, 'TIB': 1024 ** 4}
+# INFO: transferred 32.00 GiB in 120 seconds (273.1 MiB/s)
+transferred_re = re.compile(r'INFO: transferred ([\d.]+) ?(\w+) in (\d+) seconds')
+# INFO: Total bytes written: 1073741824 (1.0GiB, 120MiB/s)
+written_re = re.compile(r'INFO: Total bytes written: (\d+)')
+# INFO: archive file size: 2.41GB
+archivesize_re = re.compile(r'INFO: archive file size: ([\d.]+) ?(\w+)')
+# INFO: Finished Backup of VM 100 (00:02:05)
+finished_re = re.compile(r'INFO: Finished Backup of VM \d+ \((\d+):(\d\d):(\d\d)\)')
+
+
+def tobytes(value, unit):
+    return int(float(value) * units.get(unit.upper(), 1))
+
+
+def parsemetrics(lines):
+    """Return duration, transferred bytes, throughput and archive size found in the lines of a log."""
+    metrics = {}
+    for line in lines:
+        match = transferred_re.search(line)
+        if match:
+            metrics['transferred'] = tobytes(match.group(1), match.group(2))
+            metrics['transfer_seconds'] = int(match.group(3))
+            continue
+        match = written_re.search(line)
+        if match:
+            metrics['transferred'] = int(match.group(1))
+            continue
+        match = archivesize_re.search(line)
+        if match:
+            metrics['archive_size'] = tobytes(match.group(1), match.group(2))
+            continue
+        match = finished_re.search(line)
+        if match:
+            metrics['duration'] = int(match.group(1)) * 3600 + int(match.group(2)) * 60 + int(match.group(3))
+    if metrics.get('transferred') is not None:
+        seconds = metrics.pop('transfer_seconds', None) or metrics.get('duration')
+        if seconds:
+            metrics['throughput'] = metrics['transferred'] // seconds
+    return metrics
+
+
+def readlogtail(f, count=2):
+    """
+    Read a log backwards in chunks, every byte at most once.
+    Returns the last count non-empty lines and the lines before them,
+    up to tail_metricsbytes, as long as they may still contain metrics
+    of a finished backup.
+    """
+    f.seek(0, os.SEEK_END)
+    position = f.tell()
+    data = b''
+    while position > 0:
+        readsize = min(tail_chunksize, position)
+        position -= readsize
+        read_limit.wait(readsize)
+        f.seek(position)
+        data = f.read(readsize) + data
+        lines = data.splitlines()
+        if position > 0:
+            # the first line may be cut off
+            lines = lines[1:]
+        lines = [line for line in lines if line.strip()]
+        if len(lines) < count:
+            continue
+        if b'INFO: Finished Backup' not in lines[-1] or len(data) >= tail_metricsbytes:
+            break
+        if any(b'INFO: transferred' in line or b'INFO: Total bytes written' in line for line in lines):
+            break
+    addtimings(bytes_read=len(data))
+    if position > 0:
+        data = data.split(b'\n', 1)[-1]
+    return [line.decode('utf-8', 'replace') for line in data.splitlines(True) if line.strip()]
+
+
+# path of log file -> [inode, size, mtime_ns, code, date, metrics, time read], kept between runs
+logcache = {}
+logcache_days = 16
+
+
+def loadlogcache(filename):
+    """Load the status codes of already classified log files."""
+    try:
+        with open(filename, 'r') as f:
+            logcache.update(json.load(f))
+    except (OSError, ValueError):
+        printdebug("Cant load log cache: " + filename)
+
+
+def savelogcache(filename):
+    """Merge our results into the cache file, drop old entries and replace it atomically."""
+    from pyproxmox import atomicwrite
+    oldest = str(date.today() - timedelta(days=logcache_days)).replace('-', '_')
+    try:
+        with open(filename + '.lock', 'a') as lockfile:
+            # concurrent runs merge their results one after another
+            fcntl.flock(lockfile, fcntl.LOCK_EX)
+            merged = {}
+            try:
+                with open(filename, 'r') as f:
+                    merged = json.load(f)
+            except (OSError, ValueError):
+                pass
+            merged.update(logcache)
+            merged = dict((logfile, entry) for (logfile, entry) in merged.items() if entry[4] >= oldest)
+            atomicwrite(filename, json.dumps(merged))
+    except (OSError, ValueError):
+        printdebug("Cant save log cache: " + filename)
+
+
+def readlogstatus(logfile):
+    """
+    Classify a single log file by its last line. Returns the status code
+    ('' if it could not be read) and the metrics of a finished backup.
+    """
+    file_limit.wait(1)
+    with open(logfile, 'rb') as f:
+        printdebug('Found and could open: ' + logfile)
+        try:
+            lines = readlogtail(f)
+            tail = lines[-2:]
+            lastline = tail[-1]
+            if not lastline.endswith('\n') and len(tail) > 1 \
+                    and not any(marker in lastline for marker in logmarkers):
+                # vzdump is still writing this line, use the last complete one
+                lastline = tail[-2]
+            printdebug(lastline)
+            if 'INFO: Finished Backup' in lastline:
+                metrics = parsemetrics(lines)
+                printdebug("Metrics: " + str(metrics))
+                return 'ok', metrics
+            elif 'ERROR: ' in lastline:
+                return 'failed', {}
+            elif 'INFO: status:' in lastline:
+                return 'running', {}
+            else:
+                return 'nobak', {}
+        except Exception:
+            printdebug("Cant read file")
+            return '', {}
+
+
+def cachedlogstatus(path, filename, vmid, date, branch, storage=''):
+    """readlogstatus() of a log in a dump directory, from the log cache if it didn't change."""
+    logfile = path + '/' + filename
+    st = os.stat(logfile)
+    cached = logcache.get(logfile)
+    if cached and len(cached) > 5 and cached[:3] == [st.st_ino, st.st_size, st.st_mtime_ns]:
+        printdebug('Unchanged since last run: ' + filename)
+        addtimings(logs_cached=1)
+        return cached[3], cached[5]
+    if cached and len(cached) > 6 and cached[0] == st.st_ino and cached[3] == 'running' \
+            and path in busy_paths and time.time() - cached[6] < running_sample:
+        # vzdump is writing to this storage, look at running backups less often
+        printdebug('Still running at the last look: ' + filename)
+        addtimings(logs_cached=1)
+        return 'running', {}
+    start = time.time()
+    filecode, metrics = readlogstatus(logfile)
+    addtimings(read_ms=(time.time() - start) * 1000, logs_read=1)
+    tracespan('read log', start, vmid=vmid, storage=storage, path=logfile, date=date, branch=branch)
+    if filecode != '':
+        logcache[logfile] = [st.st_ino, st.st_size, st.st_mtime_ns, filecode, date, metrics, time.time()]
+    return filecode, metrics
+
+
+def newestfinished(path, vmid):
+    """
+    Find the newest finished backup of a VM in a dump directory, going back
+    from its newest log, and remember it in vmid_metrics. Needed for VMs
+    whose last backup failed or is still running, checkvm() stops there.
+    """
+    for (timestamp, filename) in reversed(scandumpdir(path).get(int(vmid), [])):
+        if filename <= vmid_metrics.get((path, int(vmid)), ('',))[0]:
+            return
+        try:
+            filecode, metrics = cachedlogstatus(path, filename, vmid, timestamp[:10], 'last finished')
+        except OSError:
+            continue
+        if filecode == 'ok':
+            vmid_metrics[(path, int(vmid))] = (filename, metrics)
+            return
+
+
+def readlogfile(path, vmid, date, oneday2old=False, branch='expected date', storage=''):
+    key = (path, int(vmid), date)
+    if key in logfile_results:
+        printdebug('Already checked: ' + path + '/' + 'vzdump-*-' + str(vmid) + '-' + date + '*.log')
+        return logfile_results[key]
+    if oneday2old:
+        branch = 'older than expected'
+    probestart = time.time()
     found = False
     backupok = False
     code = ''
-    printdebug('Checking this pattern: ' + path + '/' + 'vzdump-*' + str(vmid) + '-' + date + '*.log')
-    for filename in os.listdir(path):
-        if fnmatch.fnmatch(filename, 'vzdump-*' + str(vmid) + '-' + date + '*.log'):
-            printdebug('Checking Filename: ' + filename)
-            try:
-                with open(path + '/' + filename, 'r') as f:
-                    found = True
-                    if oneday2old:
-                        printdebug("WARNING - Found backup, but older than expected: " + str(vmid))
-                    printdebug('Found and could open: ' + filename)
-                    try:
-                        lastline = f.readlines()[-1]
-                        printdebug(lastline)
-                        if 'INFO: Finished Backup' in lastline:
-                            printdebug("OK")
-                            backupok = True
-                            code = 'ok'
-                        elif 'ERROR: ' in lastline:
-                            if not backupok:
-                                code = 'failed'
-                                printdebug("Backup failed")
-                        elif 'INFO: status:' in lastline:
-                            if not backupok:
-                                code = 'running'
-                                printdebug("Backup currently running")
-                        else:
-                            if not backupok:
-                                code = 'nobak'
-                                printdebug("Error: " + str(vmid))
-                    except Exception:
-                        printdebug("Cant read file")
-            except Exception:
-                printdebug("Cant open file")
+    printdebug('Checking this pattern: ' + path + '/' + 'vzdump-*-' + str(vmid) + '-' + date + '*.log')
+    for filename in findlogfiles(path, vmid, date):
+        printdebug('Checking Filename: ' + filename)
+        try:
+            filecode, metrics = cachedlogstatus(path, filename, vmid, date, branch, storage)
+            found = True
+            if oneday2old:
+                printdebug("WARNING - Found backup, but older than expected: " + str(vmid))
+        except Exception:
+            printdebug("Cant open file")
+            continue
+        if filecode == 'ok':
+            printdebug("OK")
+            backupok = True
+            code = 'ok'
+            # keep the newest finished backup of every VM and its metrics
+            if filename > vmid_metrics.get((path, int(vmid)), ('',))[0]:
+                vmid_metrics[(path, int(vmid))] = (filename, metrics)
+        elif filecode != '' and not backupok:
+            code = filecode
+            if code == 'failed':
+                printdebug("Backup failed")
+            elif code == 'running':
+                printdebug("Backup currently running")
+            else:
+                printdebug("Error: " + str(vmid))
+    logfile_results[key] = (code, found)
+    tracespan('probe ' + branch, probestart, vmid=vmid, storage=storage, path=path, date=date, code=code)
     return code, found
 
 
-today = date.today()
-datetimetoday = datetime.today()
+def checkvm(vmid, status, path, date_to_check, today=None, storage=''):
+    """Check the logs of one VM for one schedule and return its new status."""
+    if today is None:
+        today = date.today()
+    printdebug(" ")
+    printdebug("Checking VM-ID: " + str(vmid))
+    printdebug("Checking Path : " + str(path))
+    date_underscore = (str(date_to_check)).replace( '-', '_')
+    printdebug('Date with underscores: ' + date_underscore)
 
-# These values won't be altered later on
-weekdaynumber_today = today.weekday()
-weekday_today = getweekday(weekdaynumber_today)
+    scandumpdir(path, storage)
+    if path in unreachable_paths:
+        printdebug('Dump directory not reachable: ' + path)
+        if status != 'ok':
+            status = 'unreachable'
+        return status
 
-printdebug("Today      : " + weekday_today)
+    if status != 'ok':
+        status, found = readlogfile(path, vmid, date_underscore, storage=storage)
+    else:
+        printdebug("log file already checked in another schedule and is ok: " + str(vmid))
+        found = True
 
-host = ''
-user = ''
-password = ''
+    if not found:
+        # No luck?
+        # Lets see if we find a backup, which is older and return a warning instead
+        oldest_date = str(date_to_check - timedelta(days=7)).replace('-', '_')
+        latest = latestlogfile(path, vmid, str(date_to_check - timedelta(days=1)).replace('-', '_'))
+        if latest is None or latest[0] < oldest_date:
+            # nothing in the last 7 days, no need to probe every single day
+            printdebug('No older log files found: ' + str(vmid))
+            if status != 'ok':
+                status = ''
+            older_days = range(0)
+        else:
+            older_days = range(1, 8)
+        for j in older_days:
+            date_to_check_again = date_to_check - timedelta(days=j)
+            date_underscore_again = (str(date_to_check_again)).replace('-', '_')
 
-if options.apifile != '':
-    config = configparser.ConfigParser()
-    config.optionxform = str
-    config.read(options.apifile)
+            if status != 'ok':
+                status, found = readlogfile(path, vmid, date_underscore_again, True, storage=storage)
+                if status == 'ok':
+                    status = '2old'
+                    break
+                else:
+                    found = False
 
-    try:
-        host = config.get('global', 'host')
-        user = config.get('global', 'user')
-        password = config.get('global', 'password')
-    except Exception:
-        message = 'Problem with api conf file'
-        nagiosExit(nagios.unknown, str(message))
-else:
-    if options.user == '':
-        message = 'No username given, use -u'
-        nagiosExit(nagios.unknown, str(message))
-    else:
-        user = options.user
+    if not found or status not in okcodes:
+        # didn't find anything or found a broken one
+        # So let's find any backup which is newer and worked
+        date_to_check_again = date_to_check + timedelta(days=1)
+        while date_to_check_again <= today:
+            # print(type(date_to_check_again))
+            printdebug('Checking the next day: ' + str(date_to_check_again))
+            date_underscore_again = str(date_to_check_again).replace('-', '_')
 
-    if options.password == '':
-        message = 'No Password given, use -p'
-        nagiosExit(nagios.unknown, str(message))
-    else:
-        password = options.password
+            if status != 'ok':
+                code_from_last_day = status
+                status, found = readlogfile(path, vmid, date_underscore_again, branch='check next day',
+                                            storage=storage)
+            # Didnt find a working backup on the next day, so keep the old status
+            if status != 'ok':
+                status = code_from_last_day
+            date_to_check_again = date_to_check_again + timedelta(days=1)
 
-    if options.host == '':
-        message = 'No host given, use -s'
-        nagiosExit(nagios.unknown, str(message))
+        # I tried my best, but no logfile here :(
+        if not found:
+            if status != 'ok' and status not in errorcodes:
+                status = 'nolog'
+                printdebug("Error - no log file found: " + str(vmid))
+    return status
+
+
+def checkvmjobs(vmid, jobs, status='nochk', today=None):
+    """
+    Check all schedules (path, date_to_check, storage, schedule) of one VM
+    in order and return its final status.
+    """
+    vmstart = time.time()
+    for (path, date_to_check, storage, spec) in jobs:
+        start = time.time()
+        status = checkvm(vmid, status, path, date_to_check, today, storage)
+        tracespan('check schedule', start, vmid=vmid, storage=storage, path=path, date=str(date_to_check),
+                  status=status)
+    tracespan('check VM', vmstart, vmid=vmid, status=status)
+    return status
+
+
+def selectvmids(job, guests):
+    """Return the VM ids a backup job covers, in the order of the cluster resources."""
+    if str(job.get('all', 0)) == '1':
+        vmids = [guest['vmid'] for guest in guests]
+    elif job.get('pool'):
+        vmids = [guest['vmid'] for guest in guests if guest.get('pool') == job['pool']]
+    elif job.get('vmid'):
+        vmids = [int(vmid) for vmid in str(job['vmid']).split(',') if vmid.strip()]
     else:
-        host = options.host
+        vmids = []
+    if job.get('node'):
+        # the job only runs on this node; VMs the cluster doesn't know stay in to be reported
+        nodes = dict((guest['vmid'], guest.get('node')) for guest in guests)
+        vmids = [vmid for vmid in vmids if nodes.get(vmid, job['node']) == job['node']]
+    if job.get('exclude'):
+        excludes = set(int(vmid) for vmid in str(job['exclude']).split(',') if vmid.strip())
+        vmids = [vmid for vmid in vmids if vmid not in excludes]
+    return vmids
+
+
+# compression (or archive type if uncompressed) -> (offset, magic bytes)
+archive_magic = {'zst': (0, b'\x28\xb5\x2f\xfd'),
+                 'lzo': (0, b'\x89LZO\x00\r\n\x1a\n'),
+                 'gz': (0, b'\x1f\x8b'),
+                 'tgz': (0, b'\x1f\x8b'),
+                 'vma': (0, b'VMA\x00'),
+                 'tar': (257, b'ustar')}
+# test the checksums of the compressed stream, read from stdin
+archive_testers = {'zst': ['zstd', '-q', '-t'], 'lzo': ['lzop', '-q', '-t'], 'gz': ['gzip', '-t'],
+                   'tgz': ['gzip', '-t']}
+verify_levels = ['header', 'full']
+verify_chunksize = 1024 * 1024
+
 
-auth = prox_auth(host, user, password)
-prox = pyproxmox(auth)
+def archiveformat(archive):
+    """Return the compression of an archive or its type if it is not compressed, e.g. 'zst' or 'vma'."""
+    match = archivename_re.match(os.path.basename(archive))
+    return match.group(3) or match.group(2)
 
-# status = prox.getClusterStatus()
-# print status
-# config = prox.getClusterConfig()
-# print config
-# nextid = prox.getClusterVmNextId()
-# print nextid
 
-schedule = prox.getClusterBackupSchedule()
-printdebug("Schedule(s):")
-printdebug(str(schedule))
-resources = prox.getClusterResources()
+def checkarchiveheader(archive, size, expected):
+    """Return a problem of an archive found without reading all of it, '' if it looks fine."""
+    if expected and size < expected * 0.99:
+        return 'truncated (%d of %d bytes)' % (size, expected)
+    offset, magic = archive_magic[archiveformat(archive)]
+    if size < offset + len(magic):
+        return 'too small (%d bytes)' % size
+    file_limit.wait(1)
+    read_limit.wait(offset + len(magic))
+    with open(archive, 'rb') as f:
+        f.seek(offset)
+        if f.read(len(magic)) != magic:
+            return 'bad header'
+    return ''
 
-backup_all = False
 
-vmid_status = {}
-for i in schedule['data']:
-    if i['enabled'] == '1':
+def checkarchivedata(archive, limit, deadline=None):
+    """
+    Read the whole archive at the rate limit and test it with the
+    decompressor, '' if it is intact, None if the deadline stopped it.
+    """
+    import subprocess
+    command = archive_testers.get(archiveformat(archive))
+    process = None
+    if command:
         try:
-            if i['all'] == 1:
-                backup_all = True
-                for j in resources['data']:
-                    try:
-                        vmid_status[int(j['vmid'])] = 'nochk'
-                    except Exception:
-                        pass
+            process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL,
+                                       stderr=subprocess.DEVNULL)
+        except OSError:
+            printdebug("Cant run %s, only reading %s" % (command[0], archive))
+    try:
+        file_limit.wait(1)
+        with open(archive, 'rb') as f:
+            while True:
+                if not (limit.wait(verify_chunksize, deadline) and read_limit.wait(verify_chunksize, deadline)):
+                    if process is not None:
+                        process.kill()
+                        process.wait()
+                    return None
+                data = f.read(verify_chunksize)
+                if not data:
+                    break
+                addtimings(verify_bytes=len(data))
+                if process is not None:
+                    process.stdin.write(data)
+    except BrokenPipeError:
+        # the decompressor gave up early
+        pass
+    except OSError as e:
+        if process is not None:
+            process.kill()
+            process.wait()
+        return 'read error (%s)' % e.strerror
+    if process is not None:
+        try:
+            process.stdin.close()
+        except BrokenPipeError:
+            pass
+        if process.wait() != 0:
+            return 'corrupt'
+    return ''
+
+
+def verifyarchive(path, logname, metrics, level, limit, deadline=None):
+    """
+    Verify the archive of a finished backup up to the given level, see
+    verify_levels. Results are kept in the log cache per inode, size and
+    mtime, so every archive is read only once. Returns the problem or '',
+    None if the deadline came first.
+    """
+    archive = dumpdir_archives.get(path, {}).get(logname[:-len('.log')])
+    if archive is None:
+        return 'archive missing'
+    archive = path + '/' + archive
+    try:
+        st = os.stat(archive)
+        cached = logcache.get(archive)
+        if cached and cached[:3] == [st.st_ino, st.st_size, st.st_mtime_ns] \
+                and (cached[3] != '' or verify_levels.index(cached[5]['level']) >= verify_levels.index(level)):
+            printdebug('Archive already verified: ' + archive)
+            return cached[3]
+        start = time.time()
+        problem = checkarchiveheader(archive, st.st_size, metrics.get('archive_size'))
+        if problem == '' and level == 'full':
+            problem = checkarchivedata(archive, limit, deadline)
+        tracespan('verify archive', start, path=archive, level=level, problem=problem)
+    except OSError as e:
+        return 'cannot read archive (%s)' % e.strerror
+    if problem is None:
+        printdebug('Deadline reached while verifying ' + archive)
+        return None
+    printdebug('Verified %s: %s' % (archive, problem or 'ok'))
+    date = logname_re.match(logname).group(2)
+    logcache[archive] = [st.st_ino, st.st_size, st.st_mtime_ns, problem, date, {'level': level}]
+    return problem
+
+
+def verifybackups(vmid_jobs, vmid_status, level='header', workers=2, rate=0, deadline=None):
+    """
+    Verify the archive of the newest finished backup of every VM which is
+    ok (or 2old), with up to workers archives at a time and at most rate
+    bytes per second. Returns vmid -> problem of the VMs with a bad archive,
+    the problem is None for archives not started before the deadline.
+    """
+    backups = []
+    for vmid in vmid_jobs:
+        if vmid_status[vmid] in ('ok', '2old'):
+            backup = lastbackup(vmid, vmid_jobs[vmid])
+            if backup is not None:
+                backups.append((vmid, backup))
+    limit = RateLimit(rate)
+
+    def verify(item):
+        (vmid, (logname, metrics, path)) = item
+        if deadline is not None and time.time() >= deadline:
+            return None
+        return verifyarchive(path, logname, metrics, level, limit, deadline)
+
+    if workers > 1:
+        import concurrent.futures
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            problems = list(executor.map(verify, backups))
+    else:
+        problems = [verify(item) for item in backups]
+    return dict((vmid, problem) for ((vmid, backup), problem) in zip(backups, problems) if problem != '')
+
+
+def planjobs(schedule, resources, getstorage, now, path='', window=0, reset=True):
+    """
+    Find out which day and path to check for every enabled backup job and
+    which VMs it backs up. getstorage(storage) returns the storage config
+    as the API does. Returns vmid -> [(path, date_to_check, storage, schedule), ...].
+    Paths of jobs which started less than window minutes ago are added to
+    busy_paths, which is cleared first unless reset is False (several
+    clusters planned at the same time). Raises ValueError for schedules we
+    don't understand.
+    """
+    if reset:
+        busy_paths.clear()
+    # VMs of the cluster, the schedules refer to them by pool and node
+    guests = []
+    for j in resources['data']:
+        try:
+            guests.append(dict(j, vmid=int(j['vmid'])))
         except Exception:
-            for vmid in i['vmid'].split(","):
-                vmid_status[int(vmid)] = 'nochk'
+            pass
+
+    # Debug: Add a non-existent VM
+    # guests.append({'vmid': 200})
 
-for i in schedule['data']:
-    if i['enabled'] == '1':
+    vmid_jobs = {}
+    for i in schedule['data']:
+        if str(i.get('enabled', '1')) != '1':
+            continue
+        if i.get('schedule'):
+            spec = i['schedule']
+        else:
+            spec = i['dow'] + ' ' + i['starttime']
+        printdebug("------------")
+        printdebug("Storage         : " + i['storage'])
+        printdebug("Schedule        : " + spec)
         try:
-            if i['all'] == 1:
-                try:
-                    for exclude in i['exclude'].split(","):
-                        vmid_status.pop(int(exclude), 0)
-                except Exception:
-                    pass
+            lastrun, previousrun = lastruns(compileschedule(spec), now)
+        except ValueError:
+            raise ValueError('Cannot understand schedule "%s" of backup job %s' % (spec, i.get('id', '')))
+        printdebug("Now             : " + str(now))
+        printdebug("Last run        : " + str(lastrun))
+        printdebug("Run before      : " + str(previousrun))
+
+        try:
+            printdebug("VM-IDs          : " + i['vmid'])
         except Exception:
             pass
+        date_to_check = lastrun.date()
+        printdebug("Date to check:     " + str(date_to_check))
 
-# Debug: Add a non-existent VM
-# vmid_status[200] = 'nochk'
-
-# printdebug("VMID status before: " + str(vmid_status))
-
-# Iterate over all schedules
-for i in schedule['data']:
-    weekdaynumber = today.weekday()
-    weekday = getweekday(weekdaynumber)
-    printdebug("------------")
-    printdebug("Storage         : " + i['storage'])
-    printdebug("Weekdays        : " + i['dow'])
-    starttimetoday = datetime(datetimetoday.year,
-                              datetimetoday.month,
-                              datetimetoday.day,
-                              int(i['starttime'][:2]),
-                              int(i['starttime'][3:]))
-    now = datetime(datetimetoday.year,
-                   datetimetoday.month,
-                   datetimetoday.day,
-                   datetimetoday.hour,
-                   datetimetoday.minute)
-    printdebug("Start time      : " + str(i['starttime']))
-    printdebug("Now             : " + str(now))
-    if now < starttimetoday:
-        printdebug("Start time not reached today - going back one day")
-        if weekdaynumber == 0:
-            weekdaynumber = 6
+        storage = getstorage(i['storage'])
+        printdebug("Storage-Config: " + str(storage))
+        if path == '':
+            try:
+                jobpath = storage['data']['path'] + '/dump'
+            except (KeyError, TypeError):
+                raise ValueError('Cannot read the path of storage %s from the API' % i['storage'])
         else:
-            weekdaynumber -= 1
-        weekday = getweekday(weekdaynumber)
-        date_to_check = date.today() - timedelta(days=1)
+            jobpath = path
+        if now - lastrun < timedelta(minutes=window):
+            printdebug("Backup window   : still open")
+            busy_paths.add(jobpath)
+        vmids_schedule = selectvmids(i, guests)
+        printdebug("Selected VM-IDs : " + str(vmids_schedule))
+        for vmid in vmids_schedule:
+            vmid_jobs.setdefault(vmid, []).append((jobpath, date_to_check, i['storage'], spec))
+        printdebug("Dump-Path: " + jobpath)
+        printdebug("------------")
+    return vmid_jobs
+
+
+def evaluate(vmid_jobs, workers=1, today=None, deadline=None, reset=True):
+    """
+    Check the logs of every VM of planjobs() and return vmid -> status.
+    VMs not started before the deadline (a time.time()) are 'skipped'.
+    The dump directories are scanned again unless reset is False (several
+    clusters checked at the same time share the scans).
+    """
+    if reset:
+        resetscans()
+    vmid_status = dict((vmid, 'nochk') for vmid in vmid_jobs)
+
+    def check(vmid):
+        # VMs on unreachable storages are reported as such, that needs no more time
+        if deadline is not None and time.time() >= deadline \
+                and not all(job[0] in unreachable_paths for job in vmid_jobs[vmid]):
+            return 'skipped'
+        return checkvmjobs(vmid, vmid_jobs[vmid], today=today)
+
+    # scan every dump directory once before the VMs need them, all at the same
+    # time, so storages which don't answer only cost one --storagetimeout
+    paths = dict((job[0], job[2]) for jobs in vmid_jobs.values() for job in jobs)
+    if len(paths) > 1:
+        import concurrent.futures
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(paths)) as executor:
+            list(executor.map(lambda path: scandumpdir(path, paths[path], deadline), paths))
     else:
-        printdebug("Start time reached today")
-        date_to_check = date.today()
+        for (path, storage) in paths.items():
+            scandumpdir(path, storage, deadline)
 
-    try:
-        printdebug("VM-IDs          : " + i['vmid'])
-    except Exception:
-        pass
-    days = i['dow'].split(",")
-    nrdays = []
-    for day in days:
-        if day == 'mon':
-            backup_weekdaynumber = 0
-        elif day == 'tue':
-            backup_weekdaynumber = 1
-        elif day == 'wed':
-            backup_weekdaynumber = 2
-        elif day == 'thu':
-            backup_weekdaynumber = 3
-        elif day == 'fri':
-            backup_weekdaynumber = 4
-        elif day == 'sat':
-            backup_weekdaynumber = 5
-        elif day == 'sun':
-            backup_weekdaynumber = 6
-        nrdays.append(backup_weekdaynumber)
-    vmids = []
+    # Every VM only depends on its own logs, so they can be checked in parallel
+    vmids = list(vmid_status)
+    if workers > 1:
+        import concurrent.futures
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(check, vmids))
+    else:
+        results = [check(vmid) for vmid in vmids]
+    for (vmid, status) in zip(vmids, results):
+        vmid_status[vmid] = status
+    return vmid_status
 
-    # Debug: Add a non-existent VM
-    # vmids.append(200)
 
-    printdebug("Days of backup  : " + str(nrdays))
-    if weekday in i['dow']:
-        printdebug("Weekday found: " + weekday)
-        printdebug("Date to check:     " + str(date_to_check))
+# worst first, the order of the VM categories in the output
+statusorder = ['failed', 'nobak', 'nolog', 'nochk', 'unreachable', 'badarchive', 'unknown', 'skipped',
+               'running', '2old', 'ok']
+criticalcodes = ['failed', 'nobak', 'nolog', 'nochk', 'unreachable', 'badarchive']
+warningcodes = ['running', '2old']
+
+
+def nagiosresult(vmid_status):
+    """
+    Return the Nagios exit code, a headline ('' if everything is ok) and
+    status -> [vmid, ...] of all VMs, in the order of vmid_status.
+    """
+    categories = {}
+    for vmid, status in vmid_status.items():
+        if status not in statusorder:
+            status = 'unknown'
+        categories.setdefault(status, []).append(vmid)
+
+    if 'skipped' in categories:
+        message = 'Deadline reached, %d of %d VMs not checked' % (len(categories['skipped']), len(vmid_status))
+        return nagios.unknown, message, categories
+    elif 'unknown' in categories:
+        return nagios.unknown, 'Cannot read backup status', categories
+    elif 'unreachable' in categories:
+        return nagios.critical, 'At least one backup storage is not reachable', categories
+    elif any(status in categories for status in criticalcodes):
+        return nagios.critical, 'At least one backup did not work', categories
+    elif any(status in categories for status in warningcodes):
+        return nagios.warning, 'At least one backup is not finished yet or older than expected', categories
     else:
-        printdebug("Today no backup should be done.")
-        days_to_go_back = 1
-        for _ in range(7):
-            # going back up to 7 times to find the first matching day to do the backup
-            days_to_go_back += 1
-            weekdaynumber -= 1
-            if weekdaynumber < 0:
-                weekdaynumber = 6
-            weekday = getweekday(weekdaynumber)
-            if weekday in i['dow']:
-                printdebug("Weekday found: " + weekday)
-                date_to_check = date.today() - timedelta(days=days_to_go_back)
-                printdebug("Days to go back:  " + str(days_to_go_back))
-                printdebug("Date to check:     " + str(date_to_check))
+        return nagios.ok, '', categories
+
+
+def vmidranges(vmids):
+    """Compress VM ids into ranges: [100, 101, 102, 105] -> ['100-102', '105']"""
+    ranges = []
+    for vmid in sorted(set(int(vmid) for vmid in vmids)):
+        if ranges and ranges[-1][1] == vmid - 1:
+            ranges[-1][1] = vmid
+        else:
+            ranges.append([vmid, vmid])
+    return [str(first) if first == last else '%d-%d' % (first, last) for (first, last) in ranges]
+
+
+def summarize(headline, categories):
+    """First line of the output: the headline and the number of VMs per status."""
+    counts = ', '.join('%s: %d' % (status, len(categories[status]))
+                       for status in statusorder if status in categories)
+    if not counts:
+        counts = 'No VMs in any backup job'
+    if headline:
+        return headline + ' - ' + counts
+    return counts
+
+
+def fitoutput(exit_code, summary, categories, perfdata='', maxbytes=4096):
+    """
+    Return the message and perfdata for nagiosExit(): the summary, then one
+    line with the VM ids of every status but ok. Everything after the summary
+    is cut to keep the output within maxbytes (0: no limit), the perfdata
+    first, then the VM lists.
+    """
+    if maxbytes > 0:
+        free = maxbytes - len(nagiosOutput(exit_code, summary).encode())
+    else:
+        free = float('inf')
+    message = [summary]
+    for status in statusorder:
+        if status not in categories or status == 'ok':
+            continue
+        line = '%s: %s' % (status, ','.join(vmidranges(categories[status])))
+        if len(line) + 1 <= free:
+            message.append(line)
+            free -= len(line) + 1
+            continue
+        # show the first ranges of this status and how many VMs are missing
+        total = len(categories[status])
+        shown = []
+        count = 0
+        for part in vmidranges(categories[status]):
+            first, _, last = part.partition('-')
+            size = int(last or first) - int(first) + 1
+            text = '%s: %s ... %d more' % (status, ','.join(shown + [part]), total)
+            if len(text) + 1 > free:
                 break
+            shown.append(part)
+            count += size
+        if shown:
+            message.append('%s: %s ... %d more' % (status, ','.join(shown), total - count))
+            free -= len(message[-1]) + 1
+        break
+
+    values = []
+    for value in perfdata.split():
+        if len(value) + 3 > free:
+            break
+        # ' | ' before the first value, ' ' between them
+        free -= len(value) + (3 if not values else 1)
+        values.append(value)
+
+    return '\n'.join(message), ' '.join(values)
+
+
+def jsonresult(exit_code, summary, categories, perfdata=''):
+    """Machine readable result with the number and ranges of the VMs of every status."""
+    return json.dumps({'exit_code': exit_code[0], 'status': exit_code[1], 'summary': summary,
+                       'counts': dict((status, len(vmids)) for (status, vmids) in categories.items()),
+                       'vms': dict((status, ','.join(vmidranges(vmids)))
+                                   for (status, vmids) in categories.items() if status != 'ok'),
+                       'perfdata': perfdata}, sort_keys=True)
+
+
+def dictmessage(headline, categories):
+    """The message of older versions: all VM ids of every status as a dict."""
+    response = {}
+    for status in ['ok', 'failed', 'nobak', 'nolog', 'running', 'nochk', '2old', 'badarchive', 'skipped',
+                   'unreachable']:
+        if status in categories:
+            response[status] = ''.join(str(vmid) + ',' for vmid in categories[status])
+    if headline:
+        return '%s - %s' % (headline, response)
+    return '%s' % (response)
+
+
+# name -> (type, help) of the metrics written with --textfile, in this order
+textfile_metrics = [
+    ('proxmox_backup_last_success_timestamp_seconds', 'gauge',
+     'Start time of the newest finished backup of the VM.'),
+    ('proxmox_backup_age_seconds', 'gauge', 'Seconds since the start of the newest finished backup of the VM.'),
+    ('proxmox_backup_status', 'gauge', 'Backup status of the VM: 0 ok, 1 warning, 2 critical, 3 unknown.'),
+    ('proxmox_backup_check_status', 'gauge',
+     'Result of the whole check: 0 ok, 1 warning, 2 critical, 3 unknown.'),
+    ('proxmox_backup_check_duration_seconds', 'gauge', 'How long the check took.'),
+    ('proxmox_backup_check_timestamp_seconds', 'gauge', 'When the check ran.'),
+]
+
+
+def statuscode(status):
+    """Return the Nagios exit code of a VM status."""
+    if status == 'ok':
+        return nagios.ok[0]
+    elif status in warningcodes:
+        return nagios.warning[0]
+    elif status in criticalcodes:
+        return nagios.critical[0]
+    return nagios.unknown[0]
+
 
-    storage = prox.getStorageConfig(i['storage'])
-    printdebug("Storage-Config: " + str(storage))
-    if options.path == '':
-        path = storage['data']['path'] + '/dump'
+def backupmetrics(cluster, vmid_jobs, vmid_status):
+    """Return the samples (name, labels, value) of every VM for --textfile."""
+    now = time.time()
+    samples = []
+    for vmid in sorted(vmid_jobs):
+        jobs = vmid_jobs[vmid]
+        labels = {'cluster': cluster, 'vmid': str(vmid), 'status': vmid_status[vmid],
+                  'storage': ','.join(sorted(set(job[2] for job in jobs))),
+                  'schedule': ','.join(sorted(set(job[3] for job in jobs)))}
+        samples.append(('proxmox_backup_status', labels, statuscode(vmid_status[vmid])))
+        backup = lastbackup(vmid, jobs)
+        if backup is not None:
+            match = logname_re.match(backup[0])
+            started = time.mktime(time.strptime(match.group(2) + '-' + match.group(3), '%Y_%m_%d-%H_%M_%S'))
+            labels = dict(labels)
+            del labels['status']
+            samples.append(('proxmox_backup_last_success_timestamp_seconds', labels, started))
+            samples.append(('proxmox_backup_age_seconds', labels, now - started))
+    return samples
+
+
+def checkmetrics(cluster, exit_code, start):
+    """Return the samples of the check itself for --textfile."""
+    return [('proxmox_backup_check_status', {'cluster': cluster}, exit_code[0]),
+            ('proxmox_backup_check_duration_seconds', {'cluster': cluster}, time.time() - start),
+            ('proxmox_backup_check_timestamp_seconds', {'cluster': cluster}, time.time())]
+
+
+def writetextfile(filename, samples):
+    """Write the samples for the node_exporter textfile collector and replace the file atomically."""
+    lines = []
+    for (name, kind, text) in textfile_metrics:
+        # the clusters of the batch mode finish in any order
+        family = sorted([(labels, value) for (samplename, labels, value) in samples if samplename == name],
+                        key=lambda sample: sample[0]['cluster'])
+        if not family:
+            continue
+        lines.append('# HELP %s %s' % (name, text))
+        lines.append('# TYPE %s %s' % (name, kind))
+        for (labels, value) in family:
+            labeltext = ','.join('%s="%s"' % (key, str(labels[key]).replace('\\', '\\\\').replace('"', '\\"'))
+                                 for key in sorted(labels))
+            lines.append('%s{%s} %s' % (name, labeltext, round(value, 3)))
+    from pyproxmox import atomicwrite
+    try:
+        atomicwrite(filename, '\n'.join(lines) + '\n', 0o644)
+    except OSError:
+        printdebug("Cant write textfile: " + filename)
+
+
+def formatresult(exit_code, headline, categories, perfdata='', format='text'):
+    """
+    Return the output of one check in the given format. categories None
+    means the check didn't get that far and the headline says why.
+    """
+    if categories is None:
+        if format == 'json':
+            return jsonresult(exit_code, headline, {}, perfdata)
+        return nagiosOutput(exit_code, headline, perfdata)
+    if format == 'json':
+        return jsonresult(exit_code, summarize(headline, categories), categories, perfdata)
+    elif format == 'dict':
+        message = dictmessage(headline, categories)
+    else:
+        message, perfdata = fitoutput(exit_code, summarize(headline, categories), categories, perfdata,
+                                      options.maxbytes)
+    return nagiosOutput(exit_code, message, perfdata)
+
+
+def readsettings(config, section):
+    """Return the connection settings of one cluster section of the api conf file."""
+    settings = {'host': config.get(section, 'host'),
+                'port': config.getint(section, 'port', fallback=options.port),
+                'connect_timeout': config.getfloat(section, 'connect_timeout', fallback=10.0),
+                'read_timeout': config.getfloat(section, 'read_timeout', fallback=30.0),
+                'pool_size': config.getint(section, 'pool_size', fallback=4),
+                'api_workers': config.getint(section, 'api_workers', fallback=3),
+                'retries': config.getint(section, 'retries', fallback=options.retries),
+                'path': config.get(section, 'path', fallback=options.path)}
+    if config.has_option(section, 'token'):
+        settings['user'], settings['password'] = config.get(section, 'token').split('=', 1)
     else:
-        path = options.path
-    for (vmid, status) in vmid_status.items():
-        if not backup_all:
-            # get the VM ids of the specific schedule:
-            vmids_schedule = []
+        settings['user'] = config.get(section, 'user')
+        settings['password'] = config.get(section, 'password')
+    return settings
+
+
+def checkdeadline():
+    """Return the time.time() at which the check has to stop (--deadline), or None."""
+    if options.deadline > 0:
+        return starttime + options.deadline
+    return None
+
+
+def runcluster(settings, today, now, start, ticketcache=None, record='', counters=None, samples=None):
+    """
+    Check the backups of one cluster with the settings of readsettings().
+    Returns the exit code, headline, VMs per status and perfdata for
+    formatresult() and adds the metrics for --textfile to samples if given.
+    Raises ValueError for schedules we don't understand.
+    """
+    from pyproxmox import prox_auth, cached_pyproxmox
+
+    deadline = checkdeadline()
+    authstart = time.time()
+    try:
+        auth = prox_auth(settings['host'], settings['user'], settings['password'],
+                         timeout=(settings['connect_timeout'], settings['read_timeout']),
+                         pool_size=settings['pool_size'], ticket_cache=ticketcache, port=settings['port'],
+                         deadline=deadline)
+    except Exception as e:
+        tracespan('login', authstart, host=settings['host'], user=settings['user'], error=str(e))
+        raise
+    tracespan('login', authstart, host=settings['host'], user=settings['user'],
+              ticket_cached=auth.login_time == 0)
+    prox = cached_pyproxmox(auth, record=record != '', retries=settings['retries'])
+    if tracer is not None:
+        prox.trace = tracer.span
+
+    # status = prox.getClusterStatus()
+    # print status
+    # config = prox.getClusterConfig()
+    # print config
+    # nextid = prox.getClusterVmNextId()
+    # print nextid
+
+    # the schedule, resources and storage configs don't depend on each other
+    apistart = time.time()
+    schedule, resources, _ = prox.prefetch(settings['api_workers'])
+    api_ms = (time.time() - apistart) * 1000
+    for (answer, what) in [(schedule, 'backup schedule'), (resources, 'cluster resources')]:
+        if not isinstance(answer, dict) or not isinstance(answer.get('data'), list):
+            raise ValueError('Cannot read the %s from the API: %s' % (what, str(answer)[:100]))
+    printdebug("Schedule(s):")
+    printdebug(str(schedule))
 
-            for sched in i['vmid'].split(','):
-                vmids_schedule.append(int(sched))
+    # main() resets the state once for all clusters of a batch
+    vmid_jobs = planjobs(schedule, resources, prox.getStorageConfig, now, settings['path'],
+                         options.backupwindow, reset=False)
 
-            # and check only those
-            if vmid not in vmids_schedule:
+    # printdebug("VMID status before: " + str(vmid_jobs))
+
+    vmid_status = evaluate(vmid_jobs, options.workers, today, deadline, reset=False)
+
+    if options.verify != '':
+        for (vmid, problem) in verifybackups(vmid_jobs, vmid_status, options.verify, options.verifyworkers,
+                                             options.verifyrate * 1000000, deadline).items():
+            if problem is None:
+                vmid_status[vmid] = 'skipped'
                 continue
+            printdebug("Bad archive of %s: %s" % (vmid, problem))
+            vmid_status[vmid] = 'badarchive'
+
+    if record != '':
+        prox.saveRecording(record)
+
+    printdebug("API calls: " + str(prox.api_calls))
+    printdebug("API answers from cache: " + str(prox.cache_hits))
+    printdebug("API requests: %d, %.3f seconds in total" % (prox.api_requests, prox.api_time))
+
+    for vmid, status in vmid_status.items():
+        printdebug(str(vmid) + status)
+        backup = lastbackup(vmid, vmid_jobs[vmid])
+        if backup is not None:
+            printdebug("  last finished backup: %s %s" % backup[:2])
 
-        printdebug(" ")
-        printdebug("Checking VM-ID: " + str(vmid))
-        printdebug("Checking Path : " + str(path))
-        date_underscore = (str(date_to_check)).replace( '-', '_')
-        printdebug('Date with underscores: ' + date_underscore)
+    exit_code, headline, categories = nagiosresult(vmid_status)
+
+    if samples is not None:
+        cluster = settings.get('name', settings['host'])
+        samples.extend(backupmetrics(cluster, vmid_jobs, vmid_status))
+        samples.extend(checkmetrics(cluster, exit_code, start))
+
+    checkperfdata = []
+    if options.timings:
+        checkperfdata.append(perfdata(auth, prox, start, api_ms, counters))
+    if options.vmperfdata:
+        checkperfdata.append(vmperfdata(vmid_jobs))
+    return exit_code, headline, categories, ' '.join(checkperfdata)
+
+
+def checkcluster(name, settings, today, now, ticketcache=None, samples=None):
+    """runcluster() for the batch mode, a problem with one cluster only makes its own result UNKNOWN."""
+    start = time.time()
+    record = ''
+    if options.record != '':
+        record = '%s.%s' % (options.record, name)
+    try:
+        return runcluster(dict(settings, name=name), today, now, start, ticketcache, record, samples=samples)
+    except ValueError as e:
+        result = nagios.unknown, str(e), None, ''
+    except Exception as e:
+        printdebug("Cant check cluster %s: %r" % (name, e))
+        result = nagios.unknown, 'Cannot check cluster %s - %s' % (name, e), None, ''
+    if samples is not None:
+        samples.extend(checkmetrics(name, result[0], start))
+    return result
 
-        if vmid_status[int(vmid)] != 'ok':
-            vmid_status[int(vmid)], found = readlogfile(path, vmid, date_underscore)
+
+def writestatus(directory, name, output):
+    """Replace the status file of a cluster atomically, readers never see half of it."""
+    from pyproxmox import atomicwrite
+    atomicwrite(os.path.join(directory, name + '.status'), output + '\n', 0o644)
+
+
+def passiveresult(hostname, service, result):
+    """Return a result as PROCESS_SERVICE_CHECK_RESULT external command for Nagios/Icinga."""
+    exit_code = result[0]
+    # the command is one line, the long output is escaped
+    output = formatresult(*result).split(' ', 1)[1].replace('\n', '\\n')
+    return '[%d] PROCESS_SERVICE_CHECK_RESULT;%s;%s;%d;%s\n' % (time.time(), hostname, service,
+                                                                exit_code[0], output)
+
+
+def runbatch(config, apifile, today, now, samples=None):
+    """
+    Check every cluster section (one with a host) of the api conf file at
+    the same time. Writes the results of every cluster to --statusdir and
+    --passive and returns the exit code and output of the whole batch.
+    """
+    import concurrent.futures
+
+    clusters = [section for section in config.sections() if config.has_option(section, 'host')]
+    if not clusters:
+        return nagios.unknown, 'No clusters in api conf file, every section needs a host'
+
+    results = {}
+    settings = {}
+    for name in clusters:
+        try:
+            settings[name] = readsettings(config, name)
+        except Exception:
+            results[name] = (nagios.unknown, 'Problem with section %s of api conf file' % name, None, '')
+            if samples is not None:
+                samples.extend(checkmetrics(name, nagios.unknown, time.time()))
+
+    def check(name):
+        ticketcache = None
+        if not options.nocache:
+            # [global] shares its ticket with the single cluster mode
+            filename = 'check_proxmox_backup.%s.ticket' % name
+            if name == 'global':
+                filename = 'check_proxmox_backup.ticket'
+            ticketcache = os.path.join(os.path.dirname(os.path.abspath(apifile)), filename)
+        return checkcluster(name, settings[name], today, now, ticketcache, samples)
+
+    # the clusters only wait for their own API, the batch takes as long as the slowest of them
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(settings) or 1) as executor:
+        for (name, result) in zip(settings, executor.map(check, settings)):
+            results[name] = result
+
+    passive = []
+    # cluster -> why its result could not be passed on
+    undelivered = {}
+    for name in clusters:
+        if options.statusdir != '':
+            try:
+                writestatus(options.statusdir, name, formatresult(*results[name], format=options.format))
+            except OSError as e:
+                undelivered[name] = 'Cannot write status file to %s (%s)' % (options.statusdir, e.strerror)
+        if options.passive != '':
+            passive.append(passiveresult(config.get(name, 'hostname', fallback=name),
+                                         config.get(name, 'service', fallback='All defined VM backups'),
+                                         results[name]))
+    if passive:
+        try:
+            with open(options.passive, 'a') as f:
+                f.write(''.join(passive))
+        except OSError as e:
+            problem = 'Cannot write passive result to %s (%s)' % (options.passive, e.strerror)
+            for name in clusters:
+                undelivered.setdefault(name, problem)
+    for (name, problem) in undelivered.items():
+        (code, headline, categories, clusterperfdata) = results[name]
+        message = '%s, the cluster is %s' % (problem, code[1]) + (' - ' + headline if headline else '')
+        results[name] = (nagios.unknown, message, categories, clusterperfdata)
+
+    exit_code = max((results[name][0] for name in clusters), key=lambda code: code[0])
+    counts = {}
+    for name in clusters:
+        status = results[name][0][1].lower()
+        counts[status] = counts.get(status, 0) + 1
+    summary = '%d clusters - %s' % (len(clusters),
+                                    ', '.join('%s: %d' % (status, counts[status])
+                                              for status in ['critical', 'warning', 'unknown', 'ok']
+                                              if status in counts))
+    batchperfdata = ''
+    if options.timings:
+        batchperfdata = formatperfdata([('total_ms', (time.time() - starttime) * 1000, 'ms'),
+                                        ('clusters', len(clusters), '')] + countervalues(timings))
+    if options.format == 'json':
+        return exit_code, json.dumps({'exit_code': exit_code[0], 'status': exit_code[1], 'summary': summary,
+                                      'perfdata': batchperfdata,
+                                      'clusters': dict((name, json.loads(formatresult(*results[name],
+                                                                                      format='json')))
+                                                       for name in clusters)}, sort_keys=True)
+    lines = [summary]
+    for name in clusters:
+        if results[name][0] != nagios.ok:
+            # the first line of its output without the exit code and perfdata
+            firstline = formatresult(*results[name]).split('\n')[0].split(' | ')[0]
+            lines.append('%s: %s' % (name, firstline.split(' ', 1)[1]))
+    return exit_code, nagiosOutput(exit_code, '\n'.join(lines), batchperfdata)
+
+
+def waitlock(lockfile, timeout, deadline=None):
+    """
+    Lock a file exclusively, give up with UNKNOWN after timeout seconds or
+    when the deadline passes, so runs don't pile up behind a hanging one.
+    """
+    end = time.time() + timeout
+    while True:
+        try:
+            fcntl.flock(lockfile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return
+        except BlockingIOError:
+            if deadline is not None and time.time() >= deadline:
+                message = 'Deadline reached while waiting for another run with the same arguments'
+                nagiosExit(nagios.unknown, str(message))
+            if time.time() >= end:
+                message = 'Another run with the same arguments is still running after %d seconds' % timeout
+                nagiosExit(nagios.unknown, str(message))
+            time.sleep(0.1)
+
+
+def resultfilename(argv):
+    """Return the result cache file for these arguments, next to the config file or log cache, or ''."""
+    if options.resultcache != '':
+        directory = options.resultcache
+    elif options.apifile != '':
+        directory = os.path.dirname(os.path.abspath(options.apifile))
+    elif options.cachefile != '':
+        directory = os.path.dirname(os.path.abspath(options.cachefile))
+    else:
+        return ''
+    import hashlib
+    key = hashlib.sha256(json.dumps(argv).encode()).hexdigest()[:16]
+    return os.path.join(directory, 'check_proxmox_backup.%s.result' % key)
+
+
+def loadresult(filename, ttl):
+    """Return exit code, output and age in seconds of a cached result younger than ttl seconds, or None."""
+    try:
+        with open(filename, 'r') as f:
+            result = json.load(f)
+    except (OSError, ValueError):
+        return None
+    age = time.time() - result['time']
+    if age < 0 or age >= ttl:
+        return None
+    return result['exit_code'], result['output'], age
+
+
+def saveresult(filename, exit_code, output):
+    """Replace the cached result atomically."""
+    from pyproxmox import atomicwrite
+    try:
+        atomicwrite(filename, json.dumps({'time': time.time(), 'exit_code': exit_code[0], 'output': output}))
+    except (OSError, ValueError):
+        printdebug("Cant save result: " + filename)
+
+
+# appended to the first line of a cached result
+cachedmarker = ' (cached result, %ds old)'
+
+
+def markcached(output, age):
+    """Mark a cached output with its age, in front of the perfdata."""
+    if options.format == 'json':
+        result = json.loads(output)
+        result['cached_age_s'] = int(age)
+        return json.dumps(result, sort_keys=True)
+    lines = output.split('\n', 1)
+    text, bar, perfdata = lines[0].partition(' | ')
+    lines[0] = text + cachedmarker % age + bar + perfdata
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    """Run the check with the given arguments (default: the command line) and exit with its Nagios code."""
+    global options, tracer, starttime, running_sample
+    starttime = time.time()
+    (options, args) = parser.parse_args(argv)
+    resetstate()
+    tracer = None
+    if options.trace != '':
+        tracer = Trace()
+
+    # before any thread starts, they inherit the I/O priority
+    if options.idle:
+        idleio()
+    file_limit.rate = options.filerate
+    read_limit.rate = options.readrate * 1000000
+    running_sample = options.sample
+
+    resultfile = ''
+    if options.resultttl > 0:
+        resultfile = resultfilename(sys.argv[1:] if argv is None else list(argv))
+    if resultfile != '':
+        # concurrent runs with the same arguments wait here for the one which is running already
+        # and use its result, at most --resultttl seconds; the lock is released when we exit
+        try:
+            resultlock = open(resultfile + '.lock', 'a')
+        except OSError:
+            printdebug("Cant lock the result cache, not sharing results: " + resultfile)
+            resultfile = ''
+    if resultfile != '':
+        waitlock(resultlock, options.resultttl, checkdeadline())
+        cached = loadresult(resultfile, options.resultttl)
+        if cached is not None:
+            (code, output, age) = cached
+            print(markcached(output, age))
+            sys.exit(code)
+        # leave room for the age when the result is reused
+        if options.maxbytes > 0:
+            options.maxbytes = max(options.maxbytes - len(cachedmarker % options.resultttl), 1)
+
+    today = date.today()
+    datetimetoday = datetime.today()
+
+    printdebug("Today      : " + weekdays[today.weekday()])
+
+    settings = {'port': options.port, 'connect_timeout': 10.0, 'read_timeout': 30.0,
+                'pool_size': 4, 'api_workers': 3, 'retries': options.retries, 'path': options.path}
+
+    if options.apifile != '':
+        config = configparser.ConfigParser()
+        config.optionxform = str
+        config.read(options.apifile)
+
+        if not options.batch:
+            try:
+                settings = readsettings(config, 'global')
+            except Exception:
+                message = 'Problem with api conf file'
+                nagiosExit(nagios.unknown, str(message))
+    elif options.batch:
+        message = 'No api conf file with the clusters given, use -f'
+        nagiosExit(nagios.unknown, str(message))
+    else:
+        if options.token != '':
+            if '!' not in options.token or '=' not in options.token:
+                message = 'Token must look like user@realm!tokenid=secret'
+                nagiosExit(nagios.unknown, str(message))
+            settings['user'], settings['password'] = options.token.split('=', 1)
         else:
-            printdebug("log file already checked in another schedule and is ok: " + str(vmid))
-            found = True
+            if options.user == '':
+                message = 'No username given, use -u or -t'
+                nagiosExit(nagios.unknown, str(message))
+            else:
+                settings['user'] = options.user
 
-        if not found:
-            # No luck?
-            # Lets see if we find a backup, which is older and return a warning instead
-            for j in range(1, 8):
-                date_to_check_again = date_to_check - timedelta(days=j)
-                date_underscore_again = (str(date_to_check_again)).replace('-', '_')
-
-                if vmid_status[int(vmid)] != 'ok':
-                    vmid_status[int(vmid)], found = readlogfile(path, vmid, date_underscore_again, True)
-                    if vmid_status[int(vmid)] == 'ok':
-                        vmid_status[int(vmid)] = '2old'
-                        break
-                    else:
-                        found = False
-
-        if not found or vmid_status[int(vmid)] not in okcodes:
-            # didn't find anything or found a broken one
-            # So let's find any backup which is newer and worked
-            date_to_check_again = date_to_check + timedelta(days=1)
-            while date_to_check_again <= date.today():
-                # print(type(date_to_check_again))
-                printdebug('Checking the next day: ' + str(date_to_check_again))
-                date_underscore_again = str(date_to_check_again).replace('-', '_')
-
-                if vmid_status[int(vmid)] != 'ok':
-                    code_from_last_day = vmid_status[int(vmid)]
-                    vmid_status[int(vmid)], found = readlogfile(path, vmid, date_underscore_again)
-                # Didnt find a working backup on the next day, so keep the old status
-                if vmid_status[int(vmid)] != 'ok':
-                    vmid_status[int(vmid)] = code_from_last_day
-                date_to_check_again = date_to_check_again + timedelta(days=1)
-
-            # I tried my best, but no logfile here :(
-            if not found:
-                if vmid_status[int(vmid)] != 'ok' and vmid_status[int(vmid)] not in errorcodes:
-                    vmid_status[int(vmid)] = 'nolog'
-                    printdebug("Error - no log file found: " + str(vmid))
-
-    printdebug("Storage-Path: " + storage['data']['path'])
-    printdebug("------------")
-# print " "
-
-# print vmid_status
-
-OK_STATUS = True
-UNKNOWN_STATUS = False
-WARNING_STATUS = False
-CRITICAL_STATUS = False
-
-nagios_response = {'ok': '', 'failed': '', 'nobak': '', 'nolog': '', 'running': '', 'nochk': '', '2old': ''}
-for vmid, status in vmid_status.items():
-    printdebug(str(vmid) + status)
-    vmid = str(vmid)
-    if status == 'ok':
-        nagios_response['ok'] += vmid + ','
-    elif status == 'failed':
-        OK_STATUS = False
-        CRITICAL_STATUS = True
-        nagios_response['failed'] += vmid + ','
-    elif status == 'nobak':
-        OK_STATUS = False
-        CRITICAL_STATUS = True
-        nagios_response['nobak'] += vmid + ','
-    elif status == 'nolog':
-        OK_STATUS = False
-        CRITICAL_STATUS = True
-        nagios_response['nolog'] += vmid + ','
-    elif status == 'running':
-        OK_STATUS = False
-        WARNING_STATUS = True
-        nagios_response['running'] += vmid + ','
-    elif status == '2old':
-        OK_STATUS = False
-        WARNING_STATUS = True
-        nagios_response['2old'] += vmid + ','
-    elif status == 'nochk':
-        OK_STATUS = False
-        CRITICAL_STATUS = True
-        nagios_response['nochk'] += vmid + ','
+            if options.password == '':
+                message = 'No Password given, use -p'
+                nagiosExit(nagios.unknown, str(message))
+            else:
+                settings['password'] = options.password
+
+        if options.host == '':
+            message = 'No host given, use -s'
+            nagiosExit(nagios.unknown, str(message))
+        else:
+            settings['host'] = options.host
+
+    cachefile = ''
+    if not options.nocache:
+        if options.cachefile != '':
+            cachefile = options.cachefile
+        elif options.apifile != '':
+            cachefile = os.path.join(os.path.dirname(os.path.abspath(options.apifile)),
+                                     'check_proxmox_backup.cache')
+    if cachefile != '':
+        loadlogcache(cachefile)
+
+    # requests takes longer to import than everything else, only load it once we talk to the API
+    import requests
+    import urllib3
+    from pyproxmox import DeadlineExceeded
+    urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+
+    samples = None
+    if options.textfile != '':
+        samples = []
+
+    if options.batch:
+        exit_code, output = runbatch(config, options.apifile, today, datetimetoday, samples)
     else:
-        OK_STATUS = False
-        UNKNOWN_STATUS = True
-
-# clean up unused key-value-pairs
-new_nagios_response = {}
-for key, value in nagios_response.items():
-    if value != '':
-        new_nagios_response[key] = value
-
-if UNKNOWN_STATUS:
-    message = 'Cannot read backup status - %s' % (new_nagios_response)
-    nagiosExit(nagios.unknown, str(message))
-elif CRITICAL_STATUS:
-    message = 'At least one backup did not work - %s' % (new_nagios_response)
-    nagiosExit(nagios.critical, str(message))
-elif WARNING_STATUS:
-    message = 'At least one backup is not finished yet or older than expected - %s' % (new_nagios_response)
-    nagiosExit(nagios.warning, str(message))
-else:
-    message = '%s' % (new_nagios_response)
-    nagiosExit(nagios.ok, str(message))
+        ticketcache = None
+        if not options.nocache and options.apifile != '':
+            ticketcache = os.path.join(os.path.dirname(os.path.abspath(options.apifile)),
+                                       'check_proxmox_backup.ticket')
+        try:
+            result = runcluster(settings, today, datetimetoday, starttime, ticketcache, options.record, timings,
+                                samples)
+        except ValueError as e:
+            nagiosExit(nagios.unknown, str(e))
+        except DeadlineExceeded as e:
+            message = '%s after %.1f seconds, no VM was checked' % (e, time.time() - starttime)
+            nagiosExit(nagios.unknown, str(message))
+        except requests.RequestException as e:
+            message = 'API request failed, no VM was checked - %s' % e
+            nagiosExit(nagios.unknown, str(message))
+        exit_code = result[0]
+        output = formatresult(*result, format=options.format)
+
+    savetrace()
+
+    if cachefile != '':
+        savelogcache(cachefile)
+
+    if resultfile != '':
+        saveresult(resultfile, exit_code, output)
+
+    if samples is not None:
+        writetextfile(options.textfile, samples)
+
+    print(output)
+    sys.exit(exit_code[0])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+"""
+A small stand-in for the Proxmox API, good enough for check_proxmox_backup.py.
+
+It answers GET requests from fixtures, which map the API path (e.g.
+'cluster/backup' or 'nodes/pve01/storage/local/content') to the JSON the
+real API returned, usually {"data": ...}. Logins on access/ticket always
+succeed unless a fixture says otherwise. Every request is counted per path.
+Latency and errors can be injected to see how the check copes with a slow
+or flaky pveproxy.
+
+Fixtures can be recorded from a real cluster with the --record option of
+check_proxmox_backup.py (or pyproxmox's record argument). Then run the
+check against the recording, with -P pointing to a copy of the dump
+directory if needed:
+
+python mock_proxmox.py -f fixtures.json --port 8006 --latency 0.05
+python check_proxmox_backup.py -s localhost -u root@pam -p x -P /srv/dump
+
+Or from python:
+
+server = MockProxmox(loadfixtures('fixtures.json'), certfile, keyfile)
+server.start()
+... run the check with -s 127.0.0.1 --port server.port ...
+server.stop()
+print(server.calls)
+"""
+import json
+import os
+import random
+import signal
+import ssl
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from optparse import OptionParser
+from urllib.parse import urlsplit
+
+
+def loadfixtures(filename):
+    """Read fixtures recorded by pyproxmox (path -> returned JSON)."""
+    with open(filename) as f:
+        return json.load(f)
+
+
+def makecert(directory):
+    """Create a throwaway self-signed certificate, pyproxmox only talks https."""
+    certfile = os.path.join(directory, 'cert.pem')
+    keyfile = os.path.join(directory, 'key.pem')
+    subprocess.check_call(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1',
+                           '-subj', '/CN=localhost', '-keyout', keyfile, '-out', certfile],
+                          stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return certfile, keyfile
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    """Answers one API request from the fixtures of the server."""
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def send(self, code, body):
+        body = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json;charset=UTF-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def apipath(self):
+        """Return the API path with query string, e.g. 'nodes/pve01/tasks?limit=50'"""
+        url = urlsplit(self.path)
+        prefix = '/api2/json/'
+        if not url.path.startswith(prefix):
+            return None
+        path = url.path[len(prefix):].strip('/')
+        if url.query:
+            path += '?' + url.query
+        return path
+
+    def answer(self, path, default=None):
+        mock = self.server.mock
+        mock.count(path)
+        mock.delay()
+        error = mock.error(path)
+        if error:
+            self.send(error, {'data': None, 'errors': 'injected error'})
+            return
+        body = mock.lookup(path)
+        if body is None:
+            body = default
+        if body is None:
+            self.send(404, {'data': None})
+        else:
+            self.send(200, body)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        self.rfile.read(length)
+        path = self.apipath()
+        if path == 'access/ticket':
+            self.answer(path, {'data': {'ticket': 'PVE:mock@pam:00000000::mock',
+                                        'CSRFPreventionToken': 'mock', 'username': 'mock@pam'}})
+        else:
+            self.answer(path, {'data': None})
+
+    def do_GET(self):
+        self.answer(self.apipath())
+
+
+class MockProxmox:
+    """
+    The server, runs in a background thread of the calling process.
+
+    fixtures     - dict of API path -> returned JSON
+    certfile, keyfile - TLS certificate and key
+    port         - 0 picks a free port, see the port attribute after start()
+    latency      - seconds every answer is delayed, plus up to jitter seconds
+    error_rate   - share of requests answered with HTTP 500
+    errors       - dict of API path -> HTTP status to always answer with
+    """
+    def __init__(self, fixtures, certfile, keyfile, host='127.0.0.1', port=0,
+                 latency=0.0, jitter=0.0, error_rate=0.0, errors=None):
+        self.fixtures = fixtures
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.errors = errors or {}
+        self.calls = {}
+        self.lock = threading.Lock()
+        self.httpd = ThreadingHTTPServer((host, port), MockHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.mock = self
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(certfile, keyfile)
+        self.httpd.socket = context.wrap_socket(self.httpd.socket, server_side=True)
+        self.host, self.port = self.httpd.server_address[:2]
+        self.thread = None
+
+    def count(self, path):
+        with self.lock:
+            self.calls[path] = self.calls.get(path, 0) + 1
+
+    def delay(self):
+        if self.latency or self.jitter:
+            time.sleep(self.latency + random.uniform(0, self.jitter))
+
+    def error(self, path):
+        """Return the HTTP status of an injected error for this request or None."""
+        if path.split('?', 1)[0] in self.errors:
+            return self.errors[path.split('?', 1)[0]]
+        if self.error_rate and random.random() < self.error_rate:
+            return 500
+        return None
+
+    def lookup(self, path):
+        """Find the fixture of a path, storage configs are also answered from each other."""
+        fixtures = self.fixtures
+        if path in fixtures:
+            return fixtures[path]
+        path = path.split('?', 1)[0]
+        if path in fixtures:
+            return fixtures[path]
+        if path == 'storage':
+            storages = [fixtures[key]['data'] for key in sorted(fixtures)
+                        if key.startswith('storage/') and key.count('/') == 1]
+            if storages:
+                return {'data': storages}
+        elif path.startswith('storage/') and 'storage' in fixtures:
+            for storage in fixtures['storage']['data']:
+                if storage.get('storage') == path[len('storage/'):]:
+                    return {'data': storage}
+        return None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def main():
+    parser = OptionParser(usage='%prog -f FIXTURES [options]')
+    parser.add_option('-f', '--fixtures', dest='fixtures', default='',
+                      help='JSON file with the recorded API answers')
+    parser.add_option('-H', '--host', dest='host', default='127.0.0.1',
+                      help='Address to listen on (default 127.0.0.1)')
+    parser.add_option('--port', dest='port', default=8006, type='int',
+                      help='Port to listen on (default 8006)')
+    parser.add_option('--cert', dest='certfile', default='',
+                      help='TLS certificate (default: create a throwaway one)')
+    parser.add_option('--key', dest='keyfile', default='',
+                      help='TLS key of the certificate')
+    parser.add_option('-l', '--latency', dest='latency', default=0.0, type='float',
+                      help='Seconds to delay every answer')
+    parser.add_option('-j', '--jitter', dest='jitter', default=0.0, type='float',
+                      help='Up to this many more seconds of random delay')
+    parser.add_option('-e', '--error-rate', dest='error_rate', default=0.0, type='float',
+                      help='Share of requests to answer with HTTP 500 (0.0 - 1.0)')
+    parser.add_option('--fail', dest='fail', default=[], action='append',
+                      help='Always answer this API path with an error, e.g. --fail storage:500')
+    (options, args) = parser.parse_args()
+
+    if options.fixtures == '':
+        parser.error('No fixtures given, use -f')
+    errors = {}
+    for fail in options.fail:
+        path, _, status = fail.partition(':')
+        errors[path] = int(status or 500)
+
+    certdir = None
+    certfile, keyfile = options.certfile, options.keyfile
+    if certfile == '':
+        certdir = tempfile.mkdtemp(prefix='mock_proxmox.')
+        certfile, keyfile = makecert(certdir)
+    try:
+        server = MockProxmox(loadfixtures(options.fixtures), certfile, keyfile, options.host, options.port,
+                             options.latency, options.jitter, options.error_rate, errors)
+    finally:
+        if certdir:
+            for filename in (certfile, keyfile):
+                os.unlink(filename)
+            os.rmdir(certdir)
+    print('Serving %d fixtures on https://%s:%d/api2/json/' % (len(server.fixtures), server.host, server.port))
+    # print the request counts when stopped with ctrl-c or kill
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.httpd.serve_forever()
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    print(json.dumps(server.calls, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
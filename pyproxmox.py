@@ -18,7 +18,40 @@ status = b.getClusterStatus('vnode01')
 
 For more information see https://github.com/Daemonthread/pyproxmox.
 """
+import concurrent.futures
+import json
+import os
+import tempfile
+import threading
+import time
+
 import requests
+import requests.adapters
+
+
+class DeadlineExceeded(Exception):
+    """The deadline given to prox_auth passed before a request could be answered."""
+    pass
+
+
+def atomicwrite(filename, text, mode=0o600):
+    """
+    Replace a file with text atomically, readers see either the old or the
+    new content. Raises OSError and leaves the file alone if that fails.
+    """
+    fd, tmpname = tempfile.mkstemp(prefix='.' + os.path.basename(filename) + '.',
+                                   dir=os.path.dirname(os.path.abspath(filename)))
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(text)
+        os.chmod(tmpname, mode)
+        os.replace(tmpname, filename)
+    except Exception:
+        try:
+            os.unlink(tmpname)
+        except OSError:
+            pass
+        raise
 
 
 # Authentication class
@@ -30,21 +63,144 @@ class prox_auth:
     2. Valid username, including the @pve or @pam
     3. A password
 
+    Instead of username and password an API token can be given as
+    username 'user@realm!tokenid' and the token secret as password.
+    Then no login is done at all, the token is sent with every request.
+
+    Optional keyword arguments:
+
+    timeout      - seconds or a (connect, read) tuple used for every request, default None (wait forever)
+    pool_size    - number of keep-alive connections kept open to the server, default 10
+    ticket_cache - file to keep the ticket in between runs, default None (always log in)
+    port         - port of the API, default 8006
+    deadline     - time.time() after which no request is sent and DeadlineExceeded
+                   is raised, the timeouts are shortened to end there, default None
+
     Creates the required ticket and CSRF prevention token for future connections.
+    All requests share one session, so the TCP and TLS connection is reused.
+    A cached ticket is used until shortly before it expires.
 
     Designed to be instanciated then passed to the new pyproxmox class as an init parameter.
     """
-    def __init__(self, url, username, password):
+    # tickets are valid for two hours, renew them a bit earlier
+    ticket_lifetime = 7200
+    ticket_renew = 600
+
+    def __init__(self, url, username, password, timeout=None, pool_size=10, ticket_cache=None, port=8006,
+                 deadline=None):
         self.url = url
+        self.port = port
+        self.username = username
+        self.timeout = timeout
+        self.deadline = deadline
+        self.ticket_cache = ticket_cache
+        self.lock = threading.Lock()
+        # seconds spent logging in
+        self.login_time = 0.0
         self.connect_data = {"username": username, "password": password}
-        self.full_url = "https://%s:8006/api2/json/access/ticket" % (self.url)
-
-        self.response = requests.post(self.full_url, verify=False, data=self.connect_data)
-
-        self.returned_data = self.response.json()
+        self.full_url = "https://%s:%s/api2/json/access/ticket" % (self.url, self.port)
+
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+
+        self.token = '!' in username
+        if self.token:
+            self.ticket = {}
+            self.CSRF = ''
+            self.session.headers.update({'Accept': 'application/json',
+                                         'Authorization': 'PVEAPIToken=%s=%s' % (username, password)})
+        elif not self.loadTicket():
+            self.login()
+
+    def requestTimeout(self, what):
+        """
+        Return the timeout for the next request, shortened to end at the deadline.
+        Raises DeadlineExceeded if it has passed already.
+        """
+        if self.deadline is None:
+            return self.timeout
+        remaining = self.deadline - time.time()
+        if remaining <= 0:
+            raise DeadlineExceeded('Deadline reached before %s' % what)
+        if self.timeout is None:
+            return remaining
+        if isinstance(self.timeout, tuple):
+            return tuple(min(timeout, remaining) for timeout in self.timeout)
+        return min(self.timeout, remaining)
+
+    def pastDeadline(self):
+        return self.deadline is not None and time.time() >= self.deadline
+
+    def login(self):
+        """Request a new ticket from the server and store it in the ticket cache."""
+        start = time.time()
+        try:
+            self.response = self.session.post(self.full_url, verify=False,
+                                              data=self.connect_data,
+                                              timeout=self.requestTimeout('login'))
+        except (requests.ConnectionError, requests.Timeout):
+            if self.pastDeadline():
+                raise DeadlineExceeded('Deadline reached while logging in')
+            raise
+        finally:
+            self.login_time += time.time() - start
 
-        self.ticket = {'PVEAuthCookie': self.returned_data['data']['ticket']}
-        self.CSRF = self.returned_data['data']['CSRFPreventionToken']
+        try:
+            self.response.raise_for_status()
+        except requests.HTTPError as e:
+            raise requests.HTTPError('Login failed as %s - %s' % (self.username, e), response=self.response)
+        try:
+            self.returned_data = self.response.json()
+            ticket = self.returned_data['data']['ticket']
+            CSRF = self.returned_data['data']['CSRFPreventionToken']
+        except (ValueError, KeyError, TypeError):
+            raise ValueError('Login failed as %s - no ticket in the answer (HTTP %d)'
+                             % (self.username, self.response.status_code))
+
+        self.setTicket(ticket, CSRF)
+        self.issued = time.time()
+        self.saveTicket()
+
+    def setTicket(self, ticket, CSRF):
+        """Use the given ticket and CSRF prevention token for all following requests."""
+        self.ticket = {'PVEAuthCookie': ticket}
+        self.CSRF = CSRF
+
+        self.session.cookies.set('PVEAuthCookie', ticket)
+        self.session.headers.update({'Accept': 'application/json',
+                                     'CSRFPreventionToken': str(CSRF)})
+
+    def loadTicket(self):
+        """
+        Use the ticket from the ticket cache if it belongs to us and is still
+        valid. Returns True on success.
+        """
+        if not self.ticket_cache:
+            return False
+        try:
+            with open(self.ticket_cache, 'r') as f:
+                cached = json.load(f)
+            if cached['url'] != self.url or cached['username'] != self.username:
+                return False
+            if time.time() - cached['issued'] > self.ticket_lifetime - self.ticket_renew:
+                return False
+            self.setTicket(cached['ticket'], cached['CSRF'])
+            self.issued = cached['issued']
+            return True
+        except (OSError, ValueError, KeyError, TypeError):
+            return False
+
+    def saveTicket(self):
+        """Write the current ticket to the ticket cache, readable only by the owner."""
+        if not self.ticket_cache:
+            return
+        cached = {'url': self.url, 'username': self.username, 'issued': self.issued,
+                  'ticket': self.ticket['PVEAuthCookie'], 'CSRF': self.CSRF}
+        try:
+            atomicwrite(self.ticket_cache, json.dumps(cached))
+        except OSError:
+            pass
 
 
 # The meat and veg class
@@ -56,50 +212,131 @@ class pyproxmox:
     GET and POST methods are currently implemented along with quite a few
     custom API methods.
     """
+    # answers to GET requests which are worth another try
+    retry_status = (500, 502, 503, 504)
+
     # INIT
-    def __init__(self, auth_class):
-        """Take the prox_auth instance and extract the important stuff"""
+    def __init__(self, auth_class, record=False, retries=0, backoff=0.5):
+        """
+        Take the prox_auth instance and extract the important stuff.
+        With record=True all GET answers are kept in self.recorded,
+        see saveRecording.
+        GET requests which fail with a connection error, timeout or one of
+        retry_status are repeated up to retries times, waiting backoff
+        seconds and twice as long every time, as long as the deadline of
+        the prox_auth instance allows it.
+        """
+        self.retries = retries
+        self.backoff = backoff
+        self.record = record
+        self.recorded = {}
+        # number of requests and seconds spent waiting for them
+        self.api_requests = 0
+        self.api_time = 0.0
+        self.stats_lock = threading.Lock()
+        # optional function(name, start, end, args) called after every request
+        self.trace = None
+        self.auth = auth_class
         self.url = auth_class.url
+        self.port = auth_class.port
         self.ticket = auth_class.ticket
         self.CSRF = auth_class.CSRF
+        self.session = auth_class.session
+        self.timeout = auth_class.timeout
 
-    def connect(self, conn_type, option, post_data):
+    def connect(self, conn_type, option, post_data, retry=False):
         """
         The main communication method.
+        Safe to be called from several threads at once (see fetch_many).
         """
-        self.full_url = "https://%s:8006/api2/json/%s" % (self.url, option)
-
-        httpheaders = {'Accept': 'application/json', 'Content-Type': 'application/x-www-form-urlencoded'}
-
-        if conn_type == "post":
-            httpheaders['CSRFPreventionToken'] = str(self.CSRF)
-            self.response = requests.post(self.full_url, verify=False,
-                                          data=post_data,
-                                          cookies=self.ticket,
-                                          headers=httpheaders)
-
-        elif conn_type == "put":
-            httpheaders['CSRFPreventionToken'] = str(self.CSRF)
-            self.response = requests.put(self.full_url, verify=False,
-                                         data=post_data,
-                                         cookies=self.ticket,
-                                         headers=httpheaders)
-        elif conn_type == "delete":
-            httpheaders['CSRFPreventionToken'] = str(self.CSRF)
-            self.response = requests.delete(self.full_url, verify=False,
+        full_url = "https://%s:%s/api2/json/%s" % (self.url, self.port, option)
+        self.full_url = full_url
+        ticket = self.auth.ticket
+        start = time.time()
+
+        if conn_type in ("post", "put", "delete"):
+            httpheaders = {'Content-Type': 'application/x-www-form-urlencoded'}
+            response = self.session.request(conn_type.upper(), full_url, verify=False,
                                             data=post_data,
-                                            cookies=self.ticket,
-                                            headers=httpheaders)
+                                            headers=httpheaders,
+                                            timeout=self.auth.requestTimeout(option))
         elif conn_type == "get":
-            self.response = requests.get(self.full_url, verify=False,
-                                         cookies=self.ticket)
+            response = self.get(full_url, option)
+        self.response = response
+        end = time.time()
+        with self.stats_lock:
+            self.api_requests += 1
+            self.api_time += end - start
+        if self.trace:
+            self.trace('API %s %s' % (conn_type.upper(), option), start, end,
+                       {'url': full_url, 'status': response.status_code})
+
+        if response.status_code == 401 and not retry and not self.auth.token:
+            # the ticket expired or was revoked, log in again and repeat the request once
+            with self.auth.lock:
+                # another thread might have done that already
+                if self.auth.ticket == ticket:
+                    self.auth.login()
+            self.ticket = self.auth.ticket
+            self.CSRF = self.auth.CSRF
+            return self.connect(conn_type, option, post_data, retry=True)
 
         try:
-            self.returned_data = self.response.json()
-            return self.returned_data
-        except Exception:
-            print("Error in trying to process JSON")
-            print(self.response)
+            returned_data = response.json()
+            self.returned_data = returned_data
+            if self.record and conn_type == "get":
+                self.recorded[option] = returned_data
+            return returned_data
+        except ValueError:
+            # e.g. the error page of a proxy, don't let it end up in the output of a check
+            raise ValueError('Cannot read the answer to %s, not JSON (HTTP %d)'
+                             % (option, response.status_code))
+
+    def get(self, full_url, option):
+        """Send a GET request, repeat it after temporary errors, see retries."""
+        attempt = 0
+        while True:
+            try:
+                response = self.session.get(full_url, verify=False,
+                                            timeout=self.auth.requestTimeout(option))
+                if response.status_code not in self.retry_status:
+                    return response
+                if attempt >= self.retries:
+                    # still failing, don't pass the error answer on as data
+                    response.raise_for_status()
+            except (requests.ConnectionError, requests.Timeout):
+                if self.auth.pastDeadline():
+                    raise DeadlineExceeded('Deadline reached while waiting for %s' % option)
+                if attempt >= self.retries:
+                    raise
+                response = None
+            wait = self.backoff * 2 ** attempt
+            attempt += 1
+            if self.auth.deadline is not None and time.time() + wait >= self.auth.deadline:
+                if response is not None:
+                    response.raise_for_status()
+                raise DeadlineExceeded('Deadline reached while waiting to repeat %s' % option)
+            time.sleep(wait)
+
+    def saveRecording(self, filename):
+        """Write the recorded GET answers as fixtures for mock_proxmox.py"""
+        with open(filename, 'w') as f:
+            json.dump(self.recorded, f, indent=1, sort_keys=True)
+
+    def fetch_many(self, calls, max_workers=4):
+        """
+        Run several independent API methods at the same time.
+
+        calls is a list of (method, args) tuples, e.g.
+        [(b.getClusterResources, ()), (b.getStorageConfig, ('local',))]
+        At most max_workers requests are sent in parallel.
+        Returns the results in the same order as calls.
+        """
+        if max_workers <= 1 or len(calls) <= 1:
+            return [method(*args) for (method, args) in calls]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(method, *args) for (method, args) in calls]
+            return [future.result() for future in futures]
 
     """
     Methods using the GET protocol to communicate with the Proxmox API.
@@ -315,6 +552,11 @@ class pyproxmox:
         data = self.connect('get', 'nodes/%s/storage/%s/content/%s' % (node, storage, volume), None)
         return data
 
+    def getStorageList(self):
+        """List all storage configs. Returns JSON"""
+        data = self.connect('get', 'storage', None)
+        return data
+
     def getStorageConfig(self, storage):
         """Read storage config. Returns JSON"""
         data = self.connect('get', 'storage/%s' % (storage), None)
@@ -559,3 +801,77 @@ class pyproxmox:
         """Update storage configuration"""
         data = self.connect('put', "storage/%s" % (storageid), post_data)
         return data
+
+
+# Memoizing class for read-only users
+class cached_pyproxmox(pyproxmox):
+    """
+    A pyproxmox class that remembers cluster data which doesn't change
+    while a short lived program (like a monitoring check) is running.
+
+    getClusterBackupSchedule and getClusterResources are fetched once.
+    All storage configs are fetched with one call of getStorageList and
+    getStorageConfig answers from that list.
+
+    api_calls and cache_hits count per method how often the API was
+    asked and how often the answer came from memory.
+    """
+    def __init__(self, auth_class, record=False, retries=0, backoff=0.5):
+        pyproxmox.__init__(self, auth_class, record, retries, backoff)
+        self.cache = {}
+        self.api_calls = {}
+        self.cache_hits = {}
+        self.cache_lock = threading.Lock()
+
+    def cached(self, name, fetch):
+        """Return the remembered answer for name or fetch and remember it."""
+        with self.cache_lock:
+            if name in self.cache:
+                self.cache_hits[name] = self.cache_hits.get(name, 0) + 1
+                return self.cache[name]
+            self.api_calls[name] = self.api_calls.get(name, 0) + 1
+        data = fetch()
+        with self.cache_lock:
+            self.cache.setdefault(name, data)
+            return self.cache[name]
+
+    def clearCache(self):
+        """Forget all remembered answers."""
+        with self.cache_lock:
+            self.cache = {}
+
+    def prefetch(self, max_workers=3):
+        """Fetch backup schedule, cluster resources and storage list in parallel."""
+        return self.fetch_many([(self.getClusterBackupSchedule, ()),
+                                (self.getClusterResources, ()),
+                                (self.getStorageList, ())], max_workers)
+
+    def getClusterBackupSchedule(self):
+        """List vzdump backup schedule. Returns JSON"""
+        return self.cached('cluster/backup', lambda: pyproxmox.getClusterBackupSchedule(self))
+
+    def getClusterResources(self):
+        """Get cluster resources. Returns JSON"""
+        return self.cached('cluster/resources', lambda: pyproxmox.getClusterResources(self))
+
+    def getStorageList(self):
+        """List all storage configs. Returns JSON, {'data': None} if the API keeps failing"""
+        def fetch():
+            try:
+                return pyproxmox.getStorageList(self)
+            except requests.HTTPError:
+                # getStorageConfig asks for the single storages instead
+                return {'data': None}
+        return self.cached('storage', fetch)
+
+    def getStorageConfig(self, storage):
+        """Read storage config from the storage list. Returns JSON"""
+        storages = self.getStorageList()
+        try:
+            for config in storages['data']:
+                if config['storage'] == storage:
+                    return {'data': config}
+        except (KeyError, TypeError):
+            pass
+        # not in the list (or the list couldn't be read), ask for this one directly
+        return self.cached('storage/%s' % (storage), lambda: pyproxmox.getStorageConfig(self, storage))
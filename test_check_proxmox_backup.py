@@ -0,0 +1,169 @@
+"""Tests for the schedule parser, the log tail reader and the output limit of check_proxmox_backup."""
+
+import io
+import random
+from datetime import datetime, timedelta
+
+import pytest
+
+import check_proxmox_backup as check
+
+
+def minute(day, hour, minute):
+    return day * 1440 + hour * 60 + minute
+
+
+def test_legacy_spec():
+    assert check.compileschedule('mon,wed 21:00') == [minute(0, 21, 0), minute(2, 21, 0)]
+
+
+def test_calendar_events():
+    assert check.compileschedule('mon..fri 02:30') == [minute(day, 2, 30) for day in range(5)]
+    assert check.compileschedule('*/2:00') == \
+        [minute(day, hour, 0) for day in range(7) for hour in range(0, 24, 2)]
+    assert check.compileschedule('sat,sun 8..17:0/15') == \
+        [minute(day, hour, m) for day in (5, 6) for hour in range(8, 18) for m in range(0, 60, 15)]
+    assert check.compileschedule('daily') == [minute(day, 0, 0) for day in range(7)]
+    assert check.compileschedule('weekly') == [minute(0, 0, 0)]
+
+
+def test_spec_with_date():
+    with pytest.raises(ValueError):
+        check.compileschedule('2024-01-01 00:00')
+
+
+# Monday, 2024-01-08
+monday = datetime(2024, 1, 8)
+
+
+def test_lastruns_week_wrap_around():
+    table = check.compileschedule('sat 23:30')
+    assert check.lastruns(table, monday + timedelta(hours=8)) == \
+        [datetime(2024, 1, 6, 23, 30), datetime(2023, 12, 30, 23, 30)]
+
+
+def test_lastruns_not_a_backup_day():
+    # on Thursday the last backup is Wednesday's, not the one of the day before
+    table = check.compileschedule('mon,wed 21:00')
+    assert check.lastruns(table, monday + timedelta(days=3, hours=10)) == \
+        [datetime(2024, 1, 10, 21, 0), datetime(2024, 1, 8, 21, 0)]
+
+
+def test_lastruns_at_run_time():
+    table = check.compileschedule('mon,wed 21:00')
+    assert check.lastruns(table, datetime(2024, 1, 10, 21, 0, 30))[0] == datetime(2024, 1, 10, 21, 0)
+
+
+def test_lastruns_against_brute_force():
+    rnd = random.Random(1)
+    names = ['mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun']
+    for _ in range(200):
+        days = sorted(rnd.sample(range(7), rnd.randint(1, 7)))
+        hour, mins = rnd.randrange(24), rnd.randrange(60)
+        table = check.compileschedule('%s %d:%02d' % (','.join(names[day] for day in days), hour, mins))
+        now = monday + timedelta(minutes=rnd.randrange(14 * 1440))
+        expected = []
+        moment = now
+        while len(expected) < 2:
+            if moment.weekday() in days and (moment.hour, moment.minute) == (hour, mins):
+                expected.append(moment)
+            moment -= timedelta(minutes=1)
+        assert check.lastruns(table, now) == expected
+
+
+def writelog(tmp_path, data):
+    logfile = tmp_path / 'vzdump-qemu-100-2024_01_08-02_30_00.log'
+    logfile.write_bytes(data)
+    return str(logfile)
+
+
+finished = (b'INFO: status: 100% (10737418240/10737418240), sparse 0% (0), duration 100\n'
+            b'INFO: transferred 10.00 GiB in 100 seconds (102.4 MiB/s)\n'
+            b'INFO: archive file size: 5.00GB\n'
+            b'INFO: Finished Backup of VM 100 (00:01:40)\n')
+
+
+@pytest.mark.parametrize('chunksize', [1, 7, 16, 64, 4096])
+def test_readlogtail_chunk_boundaries(monkeypatch, chunksize):
+    monkeypatch.setattr(check, 'tail_chunksize', chunksize)
+    rnd = random.Random(chunksize)
+    for _ in range(50):
+        lines = [rnd.choice([b'', b' ', b'x' * rnd.randint(1, 40)]) + b'\n' for _ in range(rnd.randint(0, 12))]
+        data = b''.join(lines) + rnd.choice([b'', b'partial', b'\n\n'])
+        expected = [line.decode() for line in data.splitlines(True) if line.strip()]
+        tail = check.readlogtail(io.BytesIO(data))
+        assert tail[-2:] == expected[-2:]
+        assert expected[len(expected) - len(tail):] == tail
+
+
+def test_readlogtail_metrics_lines(monkeypatch):
+    monkeypatch.setattr(check, 'tail_chunksize', 16)
+    tail = check.readlogtail(io.BytesIO(b'INFO: starting\n' * 50 + finished))
+    assert 'INFO: transferred 10.00 GiB in 100 seconds (102.4 MiB/s)\n' in tail
+    assert tail[-1] == 'INFO: Finished Backup of VM 100 (00:01:40)\n'
+
+
+def test_readlogstatus_finished(tmp_path):
+    code, metrics = check.readlogstatus(writelog(tmp_path, finished))
+    assert code == 'ok'
+    assert metrics['duration'] == 100
+    assert metrics['transferred'] == 10 * 1024 ** 3
+    assert metrics['throughput'] == 10 * 1024 ** 3 // 100
+
+
+@pytest.mark.parametrize('data, code', [
+    (finished + b'\n\n', 'ok'),
+    (b'INFO: status: 42% (1/2)\nINFO: stat', 'running'),
+    (b'INFO: starting\nERROR: Backup of VM 100 failed - no space left\n', 'failed'),
+    (b'INFO: starting\nERROR: Backup of VM 100 fai', 'failed'),
+    (b'INFO: starting new backup job\n', 'nobak'),
+    (b'', ''),
+])
+def test_readlogstatus_last_line(tmp_path, data, code):
+    assert check.readlogstatus(writelog(tmp_path, data))[0] == code
+
+
+def test_readlogstatus_partial_line_across_chunks(tmp_path, monkeypatch):
+    monkeypatch.setattr(check, 'tail_chunksize', 8)
+    assert check.readlogstatus(writelog(tmp_path, finished + b'INFO: cleanup of temporary'))[0] == 'ok'
+
+
+def test_vmidranges():
+    assert check.vmidranges([100, 101, 102, 105]) == ['100-102', '105']
+    assert check.vmidranges([105, 100, 101, 101]) == ['100-101', '105']
+    assert check.vmidranges([]) == []
+
+
+categories = {'failed': list(range(100, 400, 2)), 'nolog': [500, 501, 502, 510], 'ok': [600]}
+perfdata = ' '.join('vm%d_age=%ds;;' % (vmid, vmid) for vmid in range(100, 200))
+
+
+@pytest.mark.parametrize('maxbytes', [60, 100, 200, 500, 1000, 4096])
+def test_fitoutput_maxbytes(maxbytes):
+    message, values = check.fitoutput(check.nagios.critical, 'summary', categories, perfdata, maxbytes)
+    assert message.split('\n')[0] == 'summary'
+    assert len(check.nagiosOutput(check.nagios.critical, message, values).encode()) <= maxbytes
+
+
+def test_fitoutput_cuts_perfdata_first():
+    full = check.fitoutput(check.nagios.critical, 'summary', categories, perfdata, 0)
+    message, values = check.fitoutput(check.nagios.critical, 'summary', categories, perfdata,
+                                      len(check.nagiosOutput(check.nagios.critical, full[0]).encode()))
+    assert message == full[0]
+    assert values == ''
+
+
+def test_fitoutput_more():
+    message, values = check.fitoutput(check.nagios.critical, 'summary', categories, '', 200)
+    lines = message.split('\n')
+    assert len(lines) == 2
+    shown, _, more = lines[1].partition(' ... ')
+    count = sum(int(last or first) - int(first) + 1
+                for (first, _, last) in (part.partition('-') for part in shown.split(': ')[1].split(',')))
+    assert more == '%d more' % (len(categories['failed']) - count)
+
+
+def test_fitoutput_unlimited():
+    message, values = check.fitoutput(check.nagios.critical, 'summary', categories, perfdata, 0)
+    assert message == 'summary\nfailed: %s\nnolog: 500-502,510' % ','.join(map(str, categories['failed']))
+    assert values == perfdata